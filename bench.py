@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+# Copyright (c) 2021 J.B. Langston
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from disk import Disk, TRACK_START, disk_offset, track_sectors
+from g64 import open_disk
+from program import State, opcodes
+from util import to_bytes
+import booze
+import petscii
+
+CODE_START = 0x1000
+CODE_OPCODES = tuple(
+    i
+    for i, op in enumerate(opcodes)
+    if not op.undocumented and op.mnemonic not in ("brk", "rts", "rti", "jmp")
+)
+
+
+def synthetic_code(rng, addr, count):
+    # straight-line code with branches and subroutine calls back into
+    # itself, ending in rts, so trace_asm visits every instruction
+    ops = [rng.choice(CODE_OPCODES) for _ in range(count)]
+    starts = []
+    for op in ops:
+        starts.append(addr)
+        addr += opcodes[op].length
+    code = bytearray()
+    for i, op in enumerate(ops):
+        opcode = opcodes[op]
+        code.append(op)
+        if opcode.mode == "r":
+            near = [
+                s for s in starts[max(0, i - 30) : i + 30] if -126 < s - starts[i] < 127
+            ]
+            code.append(rng.choice(near) - starts[i] - 2 & 0xFF)
+        elif opcode.mnemonic == "jsr":
+            code += to_bytes(rng.choice(starts))
+        elif opcode.length == 3:
+            code += to_bytes(rng.randrange(0x10000))
+        elif opcode.length == 2:
+            code.append(rng.randrange(256))
+    code.append(0x60)  # rts
+    return bytes(code)
+
+
+def synthetic_part(rng, dest, size):
+    # a mix of code, repetitive tables and runs, roughly like a demo part
+    data = bytearray()
+    while len(data) < size:
+        kind = rng.random()
+        if kind < 0.4:
+            data += synthetic_code(rng, dest + len(data), rng.randint(20, 200))
+        elif kind < 0.7:
+            table = bytes(rng.randrange(256) for _ in range(rng.randint(8, 64)))
+            data += table * rng.randint(2, 8)
+        elif kind < 0.85:
+            data += bytes((rng.randrange(256),)) * rng.randint(16, 512)
+        else:
+            data += bytes(rng.randrange(256) for _ in range(rng.randint(16, 256)))
+    return to_bytes(dest) + bytes(data[:size])
+
+
+class ImageBuilder:
+    def __init__(self):
+        self.image = bytearray(TRACK_START[36] * 256)
+        self.used = {(18, 0), (18, 1)}
+        self.entries = []
+        self.track, self.sector = 1, 0
+
+    def allocate(self):
+        while (self.track, self.sector) in self.used or self.track == 18:
+            self.sector += 1
+            if self.sector >= track_sectors(self.track):
+                self.track += 1
+                self.sector = 0
+        self.used.add((self.track, self.sector))
+        return self.track, self.sector
+
+    def write_chain(self, data):
+        chunks = [data[i : i + 254] for i in range(0, len(data), 254)] or [b""]
+        sectors = [self.allocate() for _ in chunks]
+        links = sectors[1:] + [(0, len(chunks[-1]) + 1)]
+        for chunk, (track, sector), link in zip(chunks, sectors, links):
+            offset = disk_offset(track, sector)
+            self.image[offset : offset + 2] = bytes(link)
+            self.image[offset + 2 : offset + 2 + len(chunk)] = chunk
+        return sectors[0], len(sectors)
+
+    def add_file(self, name, data):
+        (track, sector), count = self.write_chain(data)
+        self.entries.append((name, track, sector, count))
+
+    def add_index(self, chains, track=18, sector=9):
+        self.used.add((track, sector))
+        offset = disk_offset(track, sector)
+        for i, (chain_track, chain_sector) in enumerate(chains):
+            self.image[offset + 2 * i : offset + 2 * i + 2] = bytes(
+                (chain_track, chain_sector)
+            )
+
+    def build(self, name=b"BENCHMARK", id=b"BE 2A"):
+        bam = disk_offset(18, 0)
+        self.image[bam : bam + 4] = bytes((18, 1, 0x41, 0))
+        for track in range(1, 36):
+            free = [
+                s for s in range(track_sectors(track)) if (track, s) not in self.used
+            ]
+            bits = sum(1 << s for s in free)
+            self.image[bam + 4 * track : bam + 4 * track + 4] = bytes(
+                (len(free), bits & 0xFF, bits >> 8 & 0xFF, bits >> 16)
+            )
+        self.image[bam + 0x90 : bam + 0xA0] = name.ljust(16, b"\xa0")
+        self.image[bam + 0xA2 : bam + 0xA7] = id
+        directory = disk_offset(18, 1)
+        self.image[directory : directory + 2] = bytes((0, 0xFF))
+        for i, (name, track, sector, count) in enumerate(self.entries[:8]):
+            entry = directory + 32 * i
+            self.image[entry + 2 : entry + 5] = bytes((0x82, track, sector))
+            self.image[entry + 5 : entry + 21] = name.ljust(16, b"\xa0")
+            self.image[entry + 30 : entry + 32] = to_bytes(count)
+        return bytes(self.image)
+
+
+def synthetic_d64(seed=0, parts=12, size=0x2000, optimal=False):
+    # a loader crunched as b2clean plus trackmo parts crunched as b2none,
+    # listed in an index on 18/9 the way BoozeLoader disks are laid out
+    rng = random.Random(seed)
+    builder = ImageBuilder()
+    info = booze.FORMATS["b2clean"]
+    prg = synthetic_part(rng, 0x0801, size)
+    stream = booze.Boozer(prg, "b2none", optimal).crunch()
+    loader = bytearray(info.next)
+    loader[0 : len(info.signature)] = info.signature
+    loader[info.dest : info.dest + 2] = stream[2:4]
+    builder.add_file(b"BENCHMARK", bytes(loader) + stream[4:])
+    chains = []
+    for part in range(parts):
+        dest = rng.randrange(0x1000, 0xC000, 0x100)
+        prg = synthetic_part(rng, dest, size)
+        stream = booze.Boozer(prg, "b2none", optimal).crunch()
+        chains.append(builder.write_chain(stream)[0])
+    builder.add_index(chains)
+    return builder.build()
+
+
+def dense_streams(seed=0, size=0xC000):
+    # literals of a few bytes between short matches, so decoding time goes
+    # on tokens rather than on copying bytes
+    rng = random.Random(seed)
+    streams = []
+    for format in ("b1none", "b2none"):
+        data = bytearray()
+        while len(data) < size:
+            if data and rng.random() < 0.3:
+                distance = rng.randint(1, min(len(data), 300))
+                for _ in range(rng.randint(2, 4)):
+                    data.append(data[-distance])
+            else:
+                data += bytes(rng.randrange(256) for _ in range(rng.randint(1, 8)))
+        prg = to_bytes(0x1000) + bytes(data[:size])
+        streams.append((booze.Boozer(prg, format).crunch(), format))
+    return streams
+
+
+class OriginalDeboozer(booze.Deboozer):
+    # the decoder as it was before the table driven one: a bit at a time,
+    # formatting its debug messages whether or not they are printed
+    def debug(self, level, text):
+        if level < self.debug_level:
+            print(text)
+
+    def nextbyte(self):
+        byte = self.data[self.next]
+        self.next += 1
+        self.debug(3, f"nextbyte {byte:02x}")
+        return byte
+
+    def nextbit(self):
+        self.bits <<= 1
+        if not self.bits & 0xFF:
+            self.bits = self.nextbyte() << 1 | self.bits >> 8 & 1
+        bit = self.bits >> 8 & 1
+        self.debug(3, f"nextbit {bit}")
+        return bit
+
+    def decrunch(self):
+        mem = bytearray(64 * 1024)
+        put = self.dest
+        copy = 0
+        while True:
+            copy = copy or self.nextbit()
+            length = self.copylen()
+            if copy:
+                if length == 0xFF:
+                    break
+                length += 1
+                offset = self.offset(length)
+                get = put + offset
+                self.debug(
+                    2,
+                    f"copying {length:02x} byte pattern offset by {offset:04x} "
+                    f"to {put:04x}",
+                )
+                for _ in range(length):
+                    mem[put] = mem[get]
+                    put += 1
+                    get += 1
+                copy = 0
+            else:  # literal
+                self.debug(2, f"copying {length:02x} byte literal to {put:04x}")
+                for _ in range(length):
+                    mem[put] = self.nextbyte()
+                    put += 1
+                copy = length < 0xFF
+        return to_bytes(self.dest) + mem[self.dest : put]
+
+
+def crunched_streams(disk):
+    streams = []
+    trackformat = None
+    for file in disk.files:
+        if file.type_name != "del":
+            data = file.dump_data()
+            if data is not None:
+                format, info = booze.format_info(data)
+                if format != "raw":
+                    streams.append((data, format))
+                    if trackformat is None:
+                        trackformat = format[:2] + "none"
+    if trackformat is not None:
+        track, sector, index = booze.find_index(disk)
+        for track, sector in index or ():
+            streams.append((disk.dump_chain(track, sector), trackformat))
+    return streams
+
+
+def disk_chains(disk):
+    chains = [(f.file_track, f.file_sector) for f in disk.files if f.file_type != 0]
+    track, sector, index = booze.find_index(disk)
+    return chains + list(index or ())
+
+
+def measure(run, setup=None, repeat=3, minimum=0.1):
+    # best average over several rounds, each running for at least minimum
+    # seconds so fast calls aren't lost in timer noise; setup is kept out
+    # of the timing
+    best = float("inf")
+    for _ in range(repeat):
+        total = 0
+        count = 0
+        while total < minimum:
+            arg = setup() if setup is not None else None
+            start = time.perf_counter()
+            run(arg)
+            total += time.perf_counter() - start
+            count += 1
+        best = min(best, total / count)
+    return best
+
+
+def result(amount, unit, seconds):
+    return {"rate": amount / seconds, "unit": unit, "seconds": seconds}
+
+
+def bench_decrunch(results, name, streams, repeat):
+    expected = [OriginalDeboozer(d, f).decrunch() for d, f in streams]
+    for method in ("decrunch", "decrunch_stepwise"):
+        actual = [getattr(booze.Deboozer(d, f), method)() for d, f in streams]
+        if actual != expected:
+            # timings of a wrong decoder are meaningless, so fail the run
+            sys.exit(f"{method} output differs from the original decoder")
+    size = sum(len(r) for r in expected) / 1e6
+    decoders = {
+        name: lambda d, f: booze.Deboozer(d, f).decrunch(),
+        f"{name}_stepwise": lambda d, f: booze.Deboozer(d, f).decrunch_stepwise(),
+        f"{name}_original": lambda d, f: OriginalDeboozer(d, f).decrunch(),
+    }
+    for label, decode in decoders.items():
+        seconds = measure(lambda _: [decode(d, f) for d, f in streams], repeat=repeat)
+        results[label] = result(size, "MB/s", seconds)
+
+
+def bench_suite(disks, seed=0, repeat=3):
+    results = {}
+    streams = [s for disk in disks for s in crunched_streams(disk)]
+    if streams:
+        bench_decrunch(results, "decrunch", streams, repeat)
+    bench_decrunch(results, "decrunch_dense", dense_streams(seed), repeat)
+
+    chains = [(disk, chain) for disk in disks for chain in disk_chains(disk)]
+    sectors = sum(len(disk.dump_chain_view(*chain)) for disk, chain in chains)
+    if sectors:
+        seconds = measure(
+            lambda _: [disk.dump_chain(*chain) for disk, chain in chains],
+            repeat=repeat,
+        )
+        results["dump_chain"] = result(sectors, "sectors/s", seconds)
+
+    sectors = sum(len(disk.image) // 256 for disk in disks)
+    seconds = measure(
+        lambda _: [booze.find_index(disk) for disk in disks], repeat=repeat
+    )
+    results["find_index"] = result(sectors, "sectors/s", seconds)
+
+    rng = random.Random(seed)
+    text = bytes(rng.randrange(256) for _ in range(0x10000))
+    seconds = measure(lambda _: petscii.to_unicode(text), repeat=repeat)
+    results["to_unicode"] = result(len(text) / 1e6, "MB/s", seconds)
+
+    code = to_bytes(CODE_START) + synthetic_code(rng, CODE_START, 5000)
+
+    def loaded():
+        state = State()
+        state.load_prg(code)
+        return state
+
+    state = loaded()
+    state.trace_asm(CODE_START)
+    seconds = measure(lambda state: state.trace_asm(CODE_START), loaded, repeat)
+    results["trace_asm"] = result(len(state.blocks), "instructions/s", seconds)
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        change = current["rate"] / baseline[name]["rate"] - 1
+        flag = ""
+        if change < -threshold / 100:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<24} {change:+8.1%}{flag}")
+    return regressions
+
+
+def report(results):
+    for name, r in results.items():
+        print(f"{name:<24} {r['rate']:14,.2f} {r['unit']:<15} ({r['seconds']:.4f}s)")
+    for name in ("decrunch", "decrunch_dense"):
+        if name in results:
+            speedup = results[name]["rate"] / results[f"{name}_original"]["rate"]
+            print(f"{name} speedup over the original decoder: {speedup:.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark decrunching, disk access and disassembly."
+    )
+    parser.add_argument(
+        "filenames",
+        metavar="filename.d64",
+        nargs="*",
+        help="disks to benchmark on (default: a synthetic disk)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed for synthetic data")
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many runs")
+    parser.add_argument("--json", metavar="FILE", help="write results to FILE")
+    parser.add_argument(
+        "--compare", metavar="FILE", help="compare against results stored in FILE"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10,
+        help="percent slowdown reported as a regression (default: 10)",
+    )
+    parser.add_argument(
+        "--save-d64", metavar="FILE", help="save the synthetic disk image to FILE"
+    )
+    args = parser.parse_args()
+
+    if args.filenames:
+        disks = [open_disk(filename) for filename in args.filenames]
+    else:
+        image = synthetic_d64(args.seed)
+        if args.save_d64:
+            with open(args.save_d64, "wb") as f:
+                f.write(image)
+        fd, filename = tempfile.mkstemp(suffix=".d64")
+        with os.fdopen(fd, "wb") as f:
+            f.write(image)
+        try:
+            disks = [Disk(filename)]
+        finally:
+            os.remove(filename)
+
+    results = bench_suite(disks, args.seed, args.repeat)
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "disks": args.filenames or [f"synthetic:{args.seed}"],
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
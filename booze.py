@@ -18,9 +18,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import contextlib
+import csv
+import hashlib
+import io
+import json
 import os
+import re
+import struct
+from array import array
 from collections import namedtuple
-from disk import track_sectors
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from disk import Owner, track_sectors
+from g64 import open_disk
+from metrics import Metrics, count, stage
 from util import to_word, to_bytes
 
 # Reference:
@@ -29,7 +41,13 @@ from util import to_word, to_bytes
 # ByteBoozer 1.1: https://csdb.dk/release/?id=109317
 # ByteBoozer 2.0: https://csdb.dk/release/?id=145031
 
-Format = namedtuple("Format", "signature version dest first next")
+VERSION = "0.2"
+MANIFEST = "manifest.json"
+METRICS = "metrics.json"
+
+# the BASIC line that calls the decruncher takes up the first 14 bytes of
+# each signature; code is where the decruncher itself starts
+Format = namedtuple("Format", "signature version dest first next code", defaults=(14,))
 FORMATS = {
     "b1none": Format(signature=None, version=1, dest=3, first=2, next=5),
     "b1clean": Format(
@@ -64,21 +82,303 @@ FORMATS = {
 }
 
 
+Hit = namedtuple("Hit", "format offset info")
+SYS = re.compile(rb"\x9e *(\d+)")
+
+
+def sys_targets(data):
+    # file offsets that a SYS in the BASIC program at the start of the
+    # file jumps to
+    targets = []
+    if len(data) < 2 or to_word(data) != 0x801:
+        return targets
+    addr = 0x801
+    while True:
+        pos = addr - 0x801 + 2
+        end = data.find(b"\0", pos + 4)
+        if end < 0:
+            break
+        match = SYS.search(data, pos + 4, end)
+        if match:
+            targets.append(int(match.group(1)) - 0x801 + 2)
+        link = to_word(data[pos : pos + 2])
+        # stop at the end of the program, or at a link that doesn't move on
+        if link <= addr:
+            break
+        addr = link
+    return targets
+
+
+class SignatureMatcher:
+    def __init__(self, formats):
+        self.formats = {
+            format: info for format, info in formats.items() if info.signature
+        }
+        # where the BASIC line of each signature jumps to, relative to the
+        # start of the signature
+        self.entries = {
+            format: sys_targets(info.signature)[0]
+            for format, info in self.formats.items()
+        }
+        # one zero-width alternation finds every offset where the code of
+        # any decruncher starts, in a single pass of the regex engine; the
+        # BASIC line in front of it is left out, since a different line moves
+        # the code without changing it. The longest ones go first so shared
+        # prefixes don't hide them
+        signatures = sorted(
+            {info.signature[info.code :] for info in self.formats.values()},
+            key=len,
+            reverse=True,
+        )
+        self.pattern = re.compile(
+            b"(?=" + b"|".join(re.escape(s) for s in signatures) + b")"
+        )
+
+    def find(self, data):
+        hits = []
+        targets = None
+        for match in self.pattern.finditer(data):
+            code = match.start()
+            if targets is None:
+                targets = sys_targets(data)
+            for format, info in self.formats.items():
+                if data.startswith(info.signature[info.code :], code):
+                    # offset is where the signature would start if the
+                    # decruncher had the usual BASIC line in front of it.
+                    # The code is only a few bytes of common setup, so it
+                    # only counts when the file's own BASIC line runs it
+                    offset = code - info.code
+                    if offset + self.entries[format] not in targets:
+                        continue
+                    hit = relocate(info, offset)
+                    if in_bounds(hit, len(data)):
+                        hits.append(Hit(format, offset, hit))
+        return hits
+
+
+def relocate(info, offset):
+    return info._replace(
+        dest=info.dest + offset,
+        first=None if info.first is None else info.first + offset,
+        next=info.next + offset,
+    )
+
+
+def in_bounds(info, size):
+    # a hit near the end of a file can't hold the decruncher's parameters
+    if info.first is not None and not 0 <= info.first < size:
+        return False
+    return 0 <= info.dest and info.dest + 2 <= size and 0 <= info.next < size
+
+
+SIGNATURES = SignatureMatcher(FORMATS)
+
+
+def find_signatures(data):
+    return SIGNATURES.find(bytes(data))
+
+
 def format_info(data, format=None):
     if format in FORMATS:
         return format, FORMATS[format]
     elif data is not None:
-        for format, info in FORMATS.items():
-            if info.signature is not None and len(info.signature) <= len(data):
-                if data[0 : len(info.signature)] == info.signature:
-                    return format, info
+        hits = find_signatures(data)
+        if hits:
+            return hits[0].format, hits[0].info
     return "raw", None
 
 
+OFFSET1_TAB = (4, 2, 2, 2, 5, 2, 2, 3)
+OFFSET2_TAB = (0xDF, 0xFB, 0x00, 0x80, 0xEF, 0xFD, 0x80, 0xF0)
+
+
+def gamma_table(width):
+    # maps the next width bits of the stream to length | bits used << 8
+    table = [0] * (1 << width)
+    codes = [(1, 0, 0)]
+    while codes:
+        length, code, used = codes.pop()
+        if length >= 0x80:
+            shift = width - used
+            table[code << shift : code + 1 << shift] = [length | used << 8] * (
+                1 << shift
+            )
+        else:
+            shift = width - used - 1
+            table[code << shift + 1 : (code << 1) + 1 << shift] = [
+                length | used + 1 << 8
+            ] * (1 << shift)
+            codes.append((length << 1, code << 2 | 2, used + 2))
+            codes.append((length << 1 | 1, code << 2 | 3, used + 2))
+    return table
+
+
+def offset1_table(index):
+    # maps the concatenated offset bits for an index to the decoded offset
+    base = index & 4
+    width = sum(OFFSET1_TAB[base : index + 1])
+    table = []
+    for raw in range(1 << width):
+        offset = 0
+        shift = width
+        for i in range(index, base - 1, -1):
+            bits = OFFSET1_TAB[i]
+            shift -= bits
+            offset = offset << bits | raw >> shift & (1 << bits) - 1
+            if i != base:
+                offset += 1
+        table.append(-offset)
+    return table
+
+
+# gamma codes are at most 7 pairs of bits
+GAMMA_WIDTH = 14
+GAMMA_MASK = (1 << GAMMA_WIDTH) - 1
+GAMMA_TABLE = gamma_table(GAMMA_WIDTH)
+OFFSET1_WIDTH = tuple(sum(OFFSET1_TAB[i & 4 : i + 1]) for i in range(8))
+OFFSET1_TABLES = tuple(offset1_table(i) for i in range(8))
+# offset2 shifts in bits until a zero is shifted out of the prefix
+OFFSET2_WIDTH = tuple(p and 9 - (~p & 0xFF).bit_length() for p in OFFSET2_TAB)
+
+
+def offset2_value(index, raw, byte=0):
+    width = OFFSET2_WIDTH[index]
+    offset = OFFSET2_TAB[index] << width | raw
+    if offset & 0x80:
+        offset |= 0xFF00
+    else:
+        offset = (offset ^ 0xFF) << 8 | byte
+    if offset & 0x8000:
+        offset = (offset & 0x7FFF) - 0x8000
+    return offset
+
+
+def offset_codes(version, long):
+    # maps a match distance to the cheapest way of coding it as
+    # (bits, index, raw, width, byte), where byte is None unless the
+    # offset takes an extra byte from the stream
+    codes = {}
+    for index in range(4, 8) if long else range(4):
+        if version == 1:
+            width = OFFSET1_WIDTH[index]
+            coded = ((-o, raw, None) for raw, o in enumerate(OFFSET1_TABLES[index]))
+        else:
+            width = OFFSET2_WIDTH[index]
+            raws = range(1 << width)
+            if OFFSET2_TAB[index] << width & 0x80:
+                coded = ((-offset2_value(index, raw), raw, None) for raw in raws)
+            else:
+                coded = (
+                    (-offset2_value(index, raw, byte), raw, byte)
+                    for raw in raws
+                    for byte in range(256)
+                )
+        for distance, raw, byte in coded:
+            bits = 2 + width + (0 if byte is None else 8)
+            if distance > 0 and (distance not in codes or bits < codes[distance][0]):
+                codes[distance] = (bits, index & 3, raw, width, byte)
+    table = [None] * (max(codes) + 1)
+    for distance, code in codes.items():
+        table[distance] = code
+    return table
+
+
+OFFSET_CODES = {
+    (version, long): offset_codes(version, long)
+    for version in (1, 2)
+    for long in (False, True)
+}
+GAMMA_BITS = (0,) + tuple(2 * n.bit_length() - 2 + (n < 0x80) for n in range(1, 256))
+
+
+TRACE_LITERAL = 0
+TRACE_MATCH = 1
+TRACE_EVENTS = ("literal", "match")
+TRACE_STRUCT = struct.Struct("< B I I H i")
+TraceEvent = namedtuple("TraceEvent", "event pos addr length offset")
+
+
+class DecrunchTrace:
+    def __init__(self):
+        self.events = array("B")
+        self.pos = array("L")
+        self.addr = array("L")
+        self.length = array("H")
+        self.offset = array("l")
+
+    def record(self, event, pos, addr, length, offset=0):
+        self.events.append(event)
+        self.pos.append(pos)
+        self.addr.append(addr)
+        self.length.append(length)
+        self.offset.append(offset)
+
+    def __len__(self):
+        return len(self.events)
+
+    def __getitem__(self, i):
+        return TraceEvent(
+            TRACE_EVENTS[self.events[i]],
+            self.pos[i],
+            self.addr[i],
+            self.length[i],
+            self.offset[i],
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lines(self):
+        for event in self:
+            if event.event == "match":
+                yield (
+                    f"{event.pos:05x}: copying {event.length:02x} byte pattern "
+                    f"offset by {event.offset:04x} to {event.addr:04x}"
+                )
+            else:
+                yield (
+                    f"{event.pos:05x}: copying {event.length:02x} byte literal "
+                    f"to {event.addr:04x}"
+                )
+
+    def write_csv(self, filename):
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(TraceEvent._fields)
+            writer.writerows(self)
+
+    def write_binary(self, filename):
+        with open(filename, "wb") as f:
+            for i in range(len(self)):
+                f.write(
+                    TRACE_STRUCT.pack(
+                        self.events[i],
+                        self.pos[i],
+                        self.addr[i],
+                        self.length[i],
+                        self.offset[i],
+                    )
+                )
+
+    @classmethod
+    def read_binary(cls, filename):
+        trace = cls()
+        with open(filename, "rb") as f:
+            for record in TRACE_STRUCT.iter_unpack(f.read()):
+                trace.record(*record)
+        return trace
+
+
 class Deboozer:
-    def __init__(self, data, format=None, debug_level=0, **kwargs):
+    def __init__(
+        self, data, format=None, debug_level=0, trace=None, cache=None, **kwargs
+    ):
         self.data = data
         self.debug_level = debug_level
+        self.trace = trace
+        self.cache = cache
+        self.stats = None
         self.format, info = format_info(data, format)
         if self.format == "raw":
             return
@@ -91,20 +391,21 @@ class Deboozer:
         self.next = info.next
         self.print_debug(
             1,
-            f"Initialized {self.format}: "
-            f"dest = {self.dest:04x}; "
-            f"first = {self.bits:02x}; "
-            f"next = {data[info.next]:02x}",
+            "Initialized {}: dest = {:04x}; first = {:02x}; next = {:02x}",
+            self.format,
+            self.dest,
+            self.bits,
+            data[info.next],
         )
 
-    def print_debug(self, level, text):
+    def print_debug(self, level, text, *args):
         if level < self.debug_level:
-            print(text)
+            print(text.format(*args))
 
     def nextbyte(self):
         byte = self.data[self.next]
         self.next += 1
-        self.print_debug(3, f"nextbyte {byte:02x}")
+        self.print_debug(3, "nextbyte {:02x}", byte)
         return byte
 
     def nextbit(self):
@@ -112,7 +413,7 @@ class Deboozer:
         if not self.bits & 0xFF:
             self.bits = self.nextbyte() << 1 | self.bits >> 8 & 1
         bit = self.bits >> 8 & 1
-        self.print_debug(3, f"nextbit {bit}")
+        self.print_debug(3, "nextbit {}", bit)
         return bit
 
     def copylen(self):
@@ -122,10 +423,9 @@ class Deboozer:
         return length
 
     def offset1(self, index):
-        tab = (4, 2, 2, 2, 5, 2, 2, 3)
         offset = 0
         while offset <= 0xFFFF:
-            for _ in range(tab[index]):
+            for _ in range(OFFSET1_TAB[index]):
                 offset = offset << 1 | self.nextbit()
             if index & 3 == 0:
                 break
@@ -134,8 +434,7 @@ class Deboozer:
         return -offset
 
     def offset2(self, index):
-        tab = (0xDF, 0xFB, 0x00, 0x80, 0xEF, 0xFD, 0x80, 0xF0)
-        offset = tab[index]
+        offset = OFFSET2_TAB[index]
         if offset != 0:
             while True:
                 offset = offset << 1 | self.nextbit()
@@ -162,6 +461,218 @@ class Deboozer:
         if self.format == "raw":
             return self.data
         mem = bytearray(64 * 1024)
+        start, end = self.decrunch_into(mem)
+        return to_bytes(start) + mem[start:end]
+
+    def decrunch_into(self, mem):
+        if self.format == "raw":
+            raise ValueError("raw data has no load address to decrunch to")
+        if self.debug_level > 0 or self.trace is not None:
+            return self.dest, self.decode_stepwise(mem)
+        if self.cache is not None:
+            key = self.cache.key(self.data, self.format)
+            data = self.cache.get(key)
+            if data is not None:
+                # entries cached without stats are only counted as hits
+                stats = self.cache.get_stats(key)
+                self.stats = None if stats is None else dict(stats, cache_hits=1)
+                start = to_word(data)
+                end = start + len(data) - 2
+                mem[start:end] = memoryview(data)[2:]
+                return start, end
+        if not self.bits & 0xFF:
+            end = self.decode_stepwise(mem)
+        else:
+            end = self.decode(mem)
+        if self.cache is not None:
+            self.cache.put(
+                key,
+                to_bytes(self.dest),
+                memoryview(mem)[self.dest : end],
+                stats=self.stats,
+            )
+        return self.dest, end
+
+    def decode(self, mem):
+        for put in self.decode_steps(mem, 0x10000):
+            pass
+        return put
+
+    def decode_steps(self, mem, step):
+        # generator that yields put each time at least step more bytes
+        # have been decoded, and once more at the end of the stream
+        data = self.data
+        size = len(data)
+        # padding lets the last refill read a full word; overruns into it
+        # are caught by comparing the consumed bit count against size
+        src = bytes(data) + bytes(8)
+        view = memoryview(src)
+        pos = self.next
+        put = self.dest
+        # buf holds cnt unread bits, msb first; the bit register starts with
+        # the bits above the lowest set bit (the sentinel) of the first byte
+        low = (self.bits & -self.bits).bit_length()
+        buf = self.bits >> low
+        cnt = 8 - low
+        gamma = GAMMA_TABLE
+        version = self.version
+        if version == 1:
+            widths = OFFSET1_WIDTH
+            offsets = OFFSET1_TABLES
+        else:
+            widths = OFFSET2_WIDTH
+            prefixes = OFFSET2_TAB
+        begin, held = pos, cnt
+        literals = 0
+        lengths = [0] * 256
+        copy = 0
+        mark = put + step
+        while True:
+            if put >= mark:
+                yield put
+                mark = put + step
+            # a token never needs more than 29 bits, so refill once up front;
+            # bytes that turn out to be literals are handed back before use
+            if cnt < 32:
+                if pos * 8 - cnt > size * 8:
+                    raise IndexError("crunched data ended mid-stream")
+                buf = (buf & ((1 << cnt) - 1)) << 32 | int.from_bytes(
+                    src[pos : pos + 4], "big"
+                )
+                pos += 4
+                cnt += 32
+            if not copy:
+                cnt -= 1
+                copy = buf >> cnt & 1
+            code = gamma[buf >> (cnt - GAMMA_WIDTH) & GAMMA_MASK]
+            cnt -= code >> 8
+            length = code & 0xFF
+            if copy:
+                if length == 0xFF:
+                    break
+                length += 1
+                cnt -= 2
+                index = buf >> cnt & 3
+                if length >= 3:
+                    index += 4
+                width = widths[index]
+                cnt -= width
+                offset = buf >> cnt & ((1 << width) - 1)
+                if version == 1:
+                    offset = offsets[index][offset]
+                else:
+                    offset |= prefixes[index] << width
+                    if offset & 0x80:
+                        offset |= 0xFF00
+                    else:
+                        unread = cnt >> 3
+                        pos -= unread
+                        cnt -= unread << 3
+                        buf >>= unread << 3
+                        offset = (offset ^ 0xFF) << 8 | src[pos]
+                        pos += 1
+                    if offset & 0x8000:
+                        offset = (offset & 0x7FFF) - 0x8000
+                end = put + length
+                get = put + offset
+                if end > 0x10000 or get < -0x10000 or get + length > 0x10000:
+                    raise IndexError("match outside of 64K address space")
+                lengths[length] += 1
+                if get < 0 and get + length > 0:
+                    # source wraps around the top of memory
+                    for get in range(get, get + length):
+                        mem[put] = mem[get]
+                        put += 1
+                    copy = 0
+                    continue
+                get &= 0xFFFF
+                if get < put < get + length:
+                    # overlapping copy repeats the last put - get bytes
+                    pattern = mem[get:put]
+                    mem[put:end] = (pattern * (length // len(pattern) + 1))[:length]
+                else:
+                    mem[put:end] = mem[get : get + length]
+                put = end
+                copy = 0
+            else:  # literal
+                unread = cnt >> 3
+                pos -= unread
+                cnt -= unread << 3
+                buf >>= unread << 3
+                end = put + length
+                if pos + length > size:
+                    raise IndexError("crunched data ended mid-literal")
+                if end > 0x10000:
+                    raise IndexError("literal outside of 64K address space")
+                mem[put:end] = view[pos : pos + length]
+                put = end
+                pos += length
+                literals += 1
+                copy = length < 0xFF
+        if pos * 8 - cnt > size * 8:
+            raise IndexError("crunched data ended mid-stream")
+        self.record_stats(begin, held, pos, cnt, put, literals, lengths)
+        yield put
+
+    def record_stats(self, begin, held, pos, unread, put, literals, lengths):
+        # bits are counted from the unread bits in the register before and
+        # after, so bits and bytes of the stream come out the same for both
+        # decoders
+        match_bytes = sum(n * count for n, count in enumerate(lengths))
+        self.stats = dict(
+            bytes_in=len(self.data),
+            bytes_out=put - self.dest,
+            bits=(pos - begin) * 8 - unread + held,
+            literals=literals,
+            literal_bytes=put - self.dest - match_bytes,
+            matches=sum(lengths),
+            match_bytes=match_bytes,
+            lengths=lengths,
+        )
+
+    def decrunch_chunks(self, step=4096, mem=None):
+        # yields the load address and then the output in pieces as it is
+        # decoded; the pieces are views of mem, which never changes behind
+        # put, so they stay valid until mem is reused
+        if self.format == "raw":
+            yield self.data
+            return
+        yield to_bytes(self.dest)
+        if self.cache is not None and not self.debug_level and self.trace is None:
+            key = self.cache.key(self.data, self.format)
+            data = self.cache.get(key)
+            if data is not None:
+                data = memoryview(data)
+                for i in range(2, len(data), step):
+                    yield data[i : i + step]
+                return
+        if mem is None:
+            mem = bytearray(64 * 1024)
+        view = memoryview(mem)
+        start = self.dest
+        if self.debug_level > 0 or self.trace is not None or not self.bits & 0xFF:
+            # the stepwise decoder can't stop part way, so its output comes
+            # in one piece
+            steps = (self.decode_stepwise(mem),)
+        else:
+            steps = self.decode_steps(mem, step)
+        for put in steps:
+            yield view[start:put]
+            start = put
+        if self.cache is not None and not self.debug_level and self.trace is None:
+            self.cache.put(key, to_bytes(self.dest), view[self.dest : start])
+
+    def decrunch_stepwise(self):
+        if self.format == "raw":
+            return self.data
+        mem = bytearray(64 * 1024)
+        put = self.decode_stepwise(mem)
+        return to_bytes(self.dest) + mem[self.dest : put]
+
+    def decode_stepwise(self, mem):
+        begin, held = self.next, self.unread()
+        literals = 0
+        lengths = [0] * 256
         put = self.dest
         copy = 0
         while True:
@@ -175,99 +686,593 @@ class Deboozer:
                 get = put + offset
                 self.print_debug(
                     2,
-                    f"copying {length:02x} byte pattern offset by {offset:04x} to {put:04x}",
+                    "copying {:02x} byte pattern offset by {:04x} to {:04x}",
+                    length,
+                    offset,
+                    put,
                 )
+                if self.trace is not None:
+                    self.trace.record(TRACE_MATCH, self.next, put, length, offset)
+                lengths[length] += 1
                 for _ in range(length):
                     mem[put] = mem[get]
                     put += 1
                     get += 1
                 copy = 0
             else:  # literal
-                self.print_debug(2, f"copying {length:02x} byte literal to {put:04x}")
+                self.print_debug(
+                    2, "copying {:02x} byte literal to {:04x}", length, put
+                )
+                if self.trace is not None:
+                    self.trace.record(TRACE_LITERAL, self.next, put, length)
                 for _ in range(length):
                     mem[put] = self.nextbyte()
                     put += 1
+                literals += 1
                 copy = length < 0xFF
-        return to_bytes(self.dest) + mem[self.dest : put]
+        self.record_stats(
+            begin, held, self.next, self.unread(), put, literals, lengths
+        )
+        return put
+
+    def unread(self):
+        # data bits left in the register sit above the sentinel bit
+        bits = self.bits & 0xFF
+        return 8 - (bits & -bits).bit_length() if bits else 0
 
 
-def validate_index(block):
-    last = False
-    for i in range(0, len(block), 2):
-        track = block[i]
-        sector = block[i + 1]
-        if track == 0:
-            if i == 0 or sector != 0:
-                return False
+class Boozer:
+    def __init__(
+        self, data, format="b2none", optimal=False, max_chain=None, load=None, **kwargs
+    ):
+        info = FORMATS.get(format)
+        if info is None or info.signature is not None:
+            raise ValueError(f"can't crunch to {format}: no decruncher code for it")
+        self.format = format
+        self.info = info
+        self.version = info.version
+        self.dest = to_word(data[0:2])
+        self.data = bytes(data[2:])
+        if self.dest + len(self.data) > 0x10000:
+            raise ValueError("data runs past the end of the 64K address space")
+        self.load = self.dest if load is None else load
+        self.optimal = optimal
+        self.max_chain = max_chain or (256 if optimal else 32)
+        self.short_codes = OFFSET_CODES[self.version, False]
+        self.long_codes = OFFSET_CODES[self.version, True]
+
+    def crunch(self):
+        tokens = self.parse_optimal() if self.optimal else self.parse_greedy()
+        return self.encode(tokens)
+
+    def insert(self, i, head, chain):
+        key = self.data[i] << 8 | self.data[i + 1]
+        chain[i] = head[key]
+        head[key] = i
+
+    def matches(self, i, head, chain):
+        # walks the hash chain of earlier positions starting with the same
+        # two bytes, nearest first, and returns (length, distance) for each
+        # one longer than all nearer ones
+        data = self.data
+        limit = min(0xFF, len(data) - i)
+        if limit < 2:
+            return []
+        self.insert(i, head, chain)
+        short = len(self.short_codes) - 1
+        far = len(self.long_codes) - 1
+        found = []
+        best = 1
+        tries = self.max_chain
+        j = chain[i]
+        while j >= 0 and i - j <= far and tries:
+            tries -= 1
+            if data[j + best] == data[i + best] and (
+                data[j : j + best + 1] == data[i : i + best + 1]
+            ):
+                # binary search for the full length using slice compares
+                low, high = best + 1, limit
+                while low < high:
+                    mid = low + high + 1 >> 1
+                    if data[j : j + mid] == data[i : i + mid]:
+                        low = mid
+                    else:
+                        high = mid - 1
+                if low > 2 or i - j <= short:
+                    found.append((low, i - j))
+                    best = low
+                    if best == limit:
+                        break
+            j = chain[j]
+        return found
+
+    def match_bits(self, length, distance):
+        # bits for a match, not counting the flag bit in front of it
+        codes = self.long_codes if length >= 3 else self.short_codes
+        if distance >= len(codes):
+            return None
+        return GAMMA_BITS[length - 1] + codes[distance][0]
+
+    def parse_greedy(self):
+        size = len(self.data)
+        head = array("l", [-1]) * 0x10000
+        chain = array("l", [-1]) * size
+        tokens = []
+        literal = 0
+        i = 0
+        while i < size:
+            found = self.matches(i, head, chain)
+            if found:
+                length, distance = found[-1]
+                bits = self.match_bits(length, distance)
+                if bits is not None and bits + 1 < length * 8:
+                    if literal < i:
+                        tokens.append((literal, i - literal, 0))
+                    tokens.append((i, length, distance))
+                    for k in range(i + 1, min(i + length, size - 1)):
+                        self.insert(k, head, chain)
+                    i += length
+                    literal = i
+                    continue
+            i += 1
+        if literal < size:
+            tokens.append((literal, size - literal, 0))
+        return tokens
+
+    def parse_optimal(self):
+        # finds the cheapest token sequence by dynamic programming over two
+        # states per position: cost[i] decodes the first i bytes and leaves
+        # a flag bit to read next, run[i] ends with an open literal run that
+        # has to be followed by a match or the end with no flag bit
+        size = len(self.data)
+        head = array("l", [-1]) * 0x10000
+        chain = array("l", [-1]) * size
+        inf = float("inf")
+        cost = [inf] * (size + 1)
+        run = [inf] * (size + 1)
+        runlen = [0] * (size + 1)
+        # the token reaching cost[i] and whether it followed an open run
+        came = [None] * (size + 1)
+        cost[0] = 0
+        for i in range(size + 1):
+            if i:
+                n = runlen[i - 1] + 1
+                extend = run[i - 1] + 8 + GAMMA_BITS[n] - GAMMA_BITS[n - 1]
+                opened = cost[i - 1] + 1 + GAMMA_BITS[1] + 8
+                if opened <= extend:
+                    run[i], runlen[i] = opened, 1
+                else:
+                    run[i], runlen[i] = extend, n
+                if runlen[i] == 0xFF:
+                    # a full run is followed by a flag bit like a match
+                    if run[i] < cost[i]:
+                        cost[i] = run[i]
+                        came[i] = (i - 0xFF, 0xFF, 0, False)
+                    run[i], runlen[i] = inf, 0
+            if i == size:
+                break
+            found = self.matches(i, head, chain)
+            if not found:
+                continue
+            if found[-1][0] >= 32:
+                # long matches are taken whole; trying every cut of them
+                # is slow and rarely pays off
+                found = found[-1:]
+                shortest = found[0][0]
             else:
-                last = True
-        elif last or track > 35 or sector >= track_sectors(track):
-            return False
-    return True
+                shortest = 2
+            for length, distance in found:
+                for n in range(shortest, length + 1):
+                    bits = self.match_bits(n, distance)
+                    if bits is None:
+                        continue
+                    if cost[i] + 1 + bits < cost[i + n]:
+                        cost[i + n] = cost[i] + 1 + bits
+                        came[i + n] = (i, n, distance, False)
+                    if run[i] + bits < cost[i + n]:
+                        cost[i + n] = run[i] + bits
+                        came[i + n] = (i, n, distance, True)
+                shortest = length + 1
+        tokens = []
+        i = size
+        # the end marker needs a flag bit unless a literal run is open
+        open = run[size] < cost[size] + 1
+        while i:
+            if open:
+                start, length, distance, open = i - runlen[i], runlen[i], 0, False
+            else:
+                start, length, distance, open = came[i]
+            tokens.append((start, length, distance))
+            i = start
+        tokens.reverse()
+        return tokens
 
+    def putbit(self, bit):
+        # a byte joins the stream when its first bit is written, which is
+        # when the decruncher fetches it; the version 1 header byte starts
+        # with its sentinel set, so it takes seven bits
+        if not self.mask or self.out[self.slot] & self.mask:
+            self.slot = len(self.out)
+            self.out.append(0)
+            self.mask = 0x80
+        if bit:
+            self.out[self.slot] |= self.mask
+        self.mask >>= 1
 
-def parse_index(block):
-    index = []
-    for i in range(0, len(block), 2):
-        if block[i] == 0:
-            break
-        index.append((block[i], block[i + 1]))
-    return index
+    def putbits(self, value, width):
+        for shift in range(width - 1, -1, -1):
+            self.putbit(value >> shift & 1)
 
+    def putbyte(self, byte):
+        self.out.append(byte)
 
-def find_index(disk, track=18, sector="find", **kwargs):
-    tracks = range(1, 35) if track == "find" else (track,)
-    for track in tracks:
-        if sector == "find":
-            sectors = range(track_sectors(track))
+    def putlen(self, length):
+        top = length.bit_length() - 1
+        for shift in range(top - 1, -1, -1):
+            self.putbit(1)
+            self.putbit(length >> shift & 1)
+        if length < 0x80:
+            self.putbit(0)
+
+    def putoffset(self, length, distance):
+        codes = self.long_codes if length >= 3 else self.short_codes
+        bits, index, raw, width, byte = codes[distance]
+        self.putbits(index, 2)
+        self.putbits(raw, width)
+        if byte is not None:
+            self.putbyte(byte)
+
+    def encode(self, tokens):
+        info = self.info
+        self.out = bytearray(info.next)
+        self.out[0:2] = to_bytes(self.load)
+        self.out[info.dest : info.dest + 2] = to_bytes(self.dest)
+        if self.version == 1:
+            self.out[info.first] = 0x01
+            self.slot, self.mask = info.first, 0x80
         else:
-            sectors = (sector,)
-        for sector in sectors:
-            block = disk.dump_block(track, sector)
-            if validate_index(block):
-                return track, sector, parse_index(block)
+            self.slot, self.mask = None, 0
+        copy = 0
+        for start, length, distance in tokens:
+            if distance:
+                if not copy:
+                    self.putbit(1)
+                self.putlen(length - 1)
+                self.putoffset(length, distance)
+                copy = 0
+                continue
+            for chunk in range(start, start + length, 0xFF):
+                n = min(0xFF, start + length - chunk)
+                self.putbit(0)
+                self.putlen(n)
+                self.out += self.data[chunk : chunk + n]
+                copy = n < 0xFF
+        if not copy:
+            self.putbit(1)
+        self.putlen(0xFF)
+        return bytes(self.out)
+
+
+class WorkspacePool:
+    def __init__(self, limit=4):
+        self.limit = limit
+        self.free = []
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        return bytearray(64 * 1024)
+
+    def release(self, mem, start=0, end=64 * 1024):
+        # decrunching only writes between start and end, so that is all
+        # that has to be cleared before the workspace is handed out again
+        if len(self.free) < self.limit:
+            mem[start:end] = bytes(end - start)
+            self.free.append(mem)
+
+
+class OutputWriter:
+    def __init__(self, outdir, previous=None, metrics=None):
+        self.outdir = outdir
+        self.previous = previous or {}
+        self.files = {}
+        self.metrics = metrics
+
+    def write(self, filename, *chunks):
+        with stage(self.metrics, "write"):
+            digest = hashlib.sha256()
+            for chunk in chunks:
+                digest.update(chunk)
+            name = os.path.relpath(filename, self.outdir)
+            self.files[name] = digest.hexdigest()
+            size = sum(len(chunk) for chunk in chunks)
+            # leave files alone when the last run wrote the same content
+            if self.previous.get(name) == self.files[name] and os.path.isfile(
+                filename
+            ):
+                count(self.metrics, "write", unchanged=1, bytes_unchanged=size)
+                return
+            with open(filename, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            count(self.metrics, "write", files=1, bytes_out=size)
+
+    def remove_stale(self):
+        for name in self.previous:
+            if name not in self.files:
+                try:
+                    os.remove(os.path.join(self.outdir, name))
+                except OSError:
+                    pass
+
+
+def write_decrunched(filename, decr, pool, writer, metrics=None):
+    mem = pool.acquire()
+    with stage(metrics, "decrunch"):
+        start, end = decr.decrunch_into(mem)
+    if metrics is not None:
+        metrics.count_decrunch(decr.stats)
+    writer.write(filename, to_bytes(start), memoryview(mem)[start:end])
+    pool.release(mem, start, end)
+
+
+Candidate = namedtuple("Candidate", "score track sector index broken")
+INDEX_SECTORS = tuple(track_sectors(t) if 0 < t <= 35 else 0 for t in range(256))
+
+
+def owned_by_directory(links, track, sector):
+    owner = links.chain_owner(track, sector)
+    return owner is not None and owner.kind != "trackmo"
+
+
+def index_candidates(disk):
+    # the first zero track byte ends the entries; the rest of the sector
+    # must be zero padding, so most sectors are ruled out by two C-level
+    # searches before any pair is looked at
+    links = disk.links
+    padding = bytes(256)
+    candidates = []
+    for node, (track, sector) in enumerate(links.location):
+        block = bytes(disk.view[node * 256 : node * 256 + 256])
+        count = block[0::2].find(0)
+        if count == 0:
+            continue
+        if count < 0:
+            count = 128
+        elif block[count * 2 :] != padding[count * 2 :]:
+            continue
+        index = list(zip(block[0 : count * 2 : 2], block[1 : count * 2 : 2]))
+        if any(s >= INDEX_SECTORS[t] for t, s in index):
+            continue
+        # entries should start chains that end, and should not be sectors
+        # of the directory or of files; neither should the index itself
+        broken = sum(links.chain_length(t, s) <= 0 for t, s in index)
+        owned = sum(owned_by_directory(links, t, s) for t, s in index)
+        score = count - 2 * broken - owned
+        if owned_by_directory(links, track, sector):
+            score -= count
+        if track == 18:
+            score += 1
+        if score > 0:
+            candidates.append(Candidate(score, track, sector, index, broken))
+    candidates.sort(key=lambda c: (-c.score, c.track != 18, c.track, c.sector))
+    return candidates
+
+
+def find_index(disk, track=18, sector="find", **kwargs):
+    for candidate in index_candidates(disk):
+        if track != "find" and candidate.track != track:
+            continue
+        if sector != "find" and candidate.sector != sector:
+            continue
+        if candidate.broken == 0:
+            return candidate.track, candidate.sector, candidate.index
     return None, None, None
 
 
-def extract_trackmo(disk, outdir, format=None, **kwargs):
-    track, sector, index = find_index(disk, **kwargs)
+def decrunch_data(data, format, cache=None):
+    decr = Deboozer(data, format, cache=cache)
+    return decr.decrunch(), decr.stats
+
+
+def read_chain(disk, track, sector, metrics=None):
+    with stage(metrics, "chains"):
+        data = disk.dump_chain(track, sector)
+    count(metrics, "chains", chains=1, bytes=len(data))
+    return data
+
+
+def extract_trackmo(
+    disk,
+    outdir,
+    format=None,
+    pool=None,
+    jobs=1,
+    cache=None,
+    writer=None,
+    metrics=None,
+    **kwargs,
+):
+    with stage(metrics, "index"):
+        track, sector, index = find_index(disk, **kwargs)
+    count(metrics, "index", sectors=disk.links.count, entries=len(index or ()))
     os.makedirs(outdir, exist_ok=True)
+    if pool is None:
+        pool = WorkspacePool()
+    if writer is None:
+        writer = OutputWriter(outdir, metrics=metrics)
     if index is not None:
         print(f"Likely trackmo index found on track {track} at sector {sector}")
+        disk.links.add_chain(Owner("trackmo", None), track, sector, follow=False)
+        filenames = []
+        chains = []
         for i, (track, sector) in enumerate(index):
-            data = disk.dump_chain(track, sector)
+            disk.links.add_chain(Owner("trackmo", i), track, sector)
+            chains.append(read_chain(disk, track, sector, metrics))
+            filenames.append(
+                os.path.join(outdir, f"{i:02}-{track:02}-{sector:02}.prg")
+            )
+        if format is not None and jobs > 1:
+            # only the crunched bytes and format name go to the workers;
+            # map hands results back in index order
+            with ProcessPoolExecutor(jobs) as executor:
+                with stage(metrics, "decrunch"):
+                    results = list(
+                        executor.map(
+                            decrunch_data, chains, repeat(format), repeat(cache)
+                        )
+                    )
+            for filename, (data, stats) in zip(filenames, results):
+                if metrics is not None:
+                    metrics.count_decrunch(stats)
+                writer.write(filename, data)
+            return
+        for filename, data in zip(filenames, chains):
             if format is not None:
-                data = Deboozer(data, format).decrunch()
-            filename = f"{i:02}-{track:02}-{sector:02}.prg"
-            with open(os.path.join(outdir, filename), "wb") as f:
-                f.write(data)
+                decr = Deboozer(data, format, cache=cache)
+                if decr.format != "raw":
+                    write_decrunched(filename, decr, pool, writer, metrics)
+                    continue
+            writer.write(filename, data)
 
 
 def extract_disk(
-    disk, outdir, dirfile="dir.txt", fileformat=None, trackformat=None, **kwargs
+    disk,
+    outdir,
+    dirfile="dir.txt",
+    fileformat=None,
+    trackformat=None,
+    pool=None,
+    jobs=1,
+    cache=None,
+    force=False,
+    metrics=None,
+    **kwargs,
 ):
+    if metrics is not None:
+        metrics.disks += 1
+    image = hashlib.sha256(disk.view).hexdigest()
+    options = manifest_options(
+        dirfile=dirfile, fileformat=fileformat, trackformat=trackformat, **kwargs
+    )
+    manifest = read_manifest(outdir)
+    if not force and manifest_current(outdir, manifest, image, options):
+        print("Disk unchanged since last extraction, skipping")
+        return
+    if disk.errors:
+        print(f"{len(disk.errors)} sectors could not be read cleanly:")
+        for (track, sector), error in sorted(disk.errors.items()):
+            print(f"  {track}/{sector}: {error}")
     os.makedirs(outdir, exist_ok=True)
+    if pool is None:
+        pool = WorkspacePool()
+    previous = manifest["files"] if manifest is not None else None
+    writer = OutputWriter(outdir, previous, metrics)
     if dirfile is not None:
-        with open(os.path.join(outdir, dirfile), "w") as f:
-            f.write(disk.dir_list(**kwargs))
+        writer.write(
+            os.path.join(outdir, dirfile), disk.dir_list(**kwargs).encode("utf-8")
+        )
     filedir = os.path.join(outdir, "files")
     decdir = os.path.join(filedir, "decrunched")
     os.makedirs(filedir, exist_ok=True)
     for file in disk.files:
         if file.type_name != "del":
-            data = file.dump_data()
+            if disk.links.chain_length(file.file_track, file.file_sector) < 0:
+                print(f"Skipping {file.dos_name()}: sector chain never ends")
+                continue
+            data = read_chain(disk, file.file_track, file.file_sector, metrics)
             if data is not None:
-                with open(os.path.join(filedir, file.dos_name(**kwargs)), "wb") as f:
-                    f.write(data)
+                writer.write(os.path.join(filedir, file.dos_name(**kwargs)), data)
                 if fileformat != "raw":
-                    decr = Deboozer(data, fileformat)
+                    decr = Deboozer(data, fileformat, cache=cache)
                     if decr.format != "raw":
+                        os.makedirs(decdir, exist_ok=True)
+                        try:
+                            write_decrunched(
+                                os.path.join(decdir, file.dos_name(**kwargs)),
+                                decr,
+                                pool,
+                                writer,
+                                metrics,
+                            )
+                        except IndexError as e:
+                            # a detected signature can still be a false hit;
+                            # keep the file raw rather than fail the disk
+                            if fileformat is not None:
+                                raise
+                            print(
+                                f"Not decrunching {file.dos_name()} "
+                                f"as {decr.format}: {e}"
+                            )
+                            continue
                         if trackformat is None:
                             trackformat = decr.format[:2] + "none"
-                        data = decr.decrunch()
-                        os.makedirs(decdir, exist_ok=True)
-                        with open(
-                            os.path.join(decdir, file.dos_name(**kwargs)), "wb"
-                        ) as f:
-                            f.write(data)
-    extract_trackmo(disk, os.path.join(outdir, "trackmo"), format=trackformat, **kwargs)
+    extract_trackmo(
+        disk,
+        os.path.join(outdir, "trackmo"),
+        format=trackformat,
+        pool=pool,
+        jobs=jobs,
+        cache=cache,
+        writer=writer,
+        metrics=metrics,
+        **kwargs,
+    )
+    writer.remove_stale()
+    write_manifest(outdir, image, options, writer.files)
+    if metrics is not None:
+        metrics.write(os.path.join(outdir, METRICS))
+
+
+def manifest_options(**options):
+    # round trip through JSON so options compare equal to a loaded manifest
+    return json.loads(json.dumps(options, sort_keys=True, default=repr))
+
+
+def read_manifest(outdir):
+    try:
+        with open(os.path.join(outdir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def manifest_current(outdir, manifest, image, options):
+    return (
+        manifest is not None
+        and manifest.get("version") == VERSION
+        and manifest.get("image") == image
+        and manifest.get("options") == options
+        and all(
+            os.path.isfile(os.path.join(outdir, name))
+            for name in manifest.get("files", ())
+        )
+    )
+
+
+def write_manifest(outdir, image, options, files):
+    manifest = {"version": VERSION, "image": image, "options": options, "files": files}
+    with open(os.path.join(outdir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def dump_dir(filename):
+    return os.path.splitext(filename)[0] + ".dump"
+
+
+def extract_image(filename, metrics=False, **kwargs):
+    # runs in a worker process, so output is captured and handed back to
+    # be printed in order, and any failure is limited to this one image;
+    # metrics come back as a dict so they can be added up across disks
+    output = io.StringIO()
+    error = None
+    collected = Metrics() if metrics else None
+    with contextlib.redirect_stdout(output):
+        try:
+            disk = open_disk(filename, use_mmap=True, metrics=collected)
+            extract_disk(disk, dump_dir(filename), metrics=collected, **kwargs)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+    if collected is not None:
+        collected = collected.as_dict()
+    return output.getvalue(), error, collected
@@ -0,0 +1,133 @@
+# Copyright (c) 2021 J.B. Langston
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import json
+import os
+import tempfile
+
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "debooze")
+DEFAULT_LIMIT = 256 * 1024 * 1024
+
+
+class DecrunchCache:
+    def __init__(self, directory=DEFAULT_DIR, limit=DEFAULT_LIMIT):
+        self.directory = directory
+        self.limit = limit
+        # total size is only worked out when something is first stored, so
+        # a cache that is only read from never scans the directory
+        self.size = None
+
+    def key(self, data, format):
+        digest = hashlib.sha256(format.encode())
+        digest.update(b"\0")
+        digest.update(data)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".prg")
+
+    def stats_path(self, path):
+        # decoder stats are kept next to the entry, so metrics don't lose
+        # them on a hit
+        return path[: -len(".prg")] + ".json"
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # the modification time doubles as the last use for eviction
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def get_stats(self, key):
+        try:
+            with open(self.stats_path(self.path(key))) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, *chunks, stats=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if stats is not None:
+            self.write(self.stats_path(path), json.dumps(stats).encode())
+        # another worker may already have stored this key; only count the
+        # difference when its entry gets replaced
+        try:
+            old = os.path.getsize(path)
+        except OSError:
+            old = 0
+        self.write(path, *chunks)
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        else:
+            self.size += os.path.getsize(path) - old
+        if self.size > self.limit:
+            self.evict()
+
+    def write(self, path, *chunks):
+        # write to a temporary file first so parallel workers never see a
+        # partially written entry
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(temp, path)
+
+    def remove(self, path):
+        for name in (path, self.stats_path(path)):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    def entries(self):
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(".prg"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        # drop least recently used entries until the cache is down to
+        # three quarters of its limit, so eviction doesn't run on every put
+        entries = sorted(self.entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.limit * 3 // 4:
+                break
+            self.remove(path)
+            self.size -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            self.remove(path)
+        self.size = 0
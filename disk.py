@@ -18,9 +18,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import mmap
 import struct
+from array import array
 from collections import namedtuple
 
+from metrics import count, stage
 import petscii
 
 # From https://vice-emu.sourceforge.io/vice_17.html#SEC345
@@ -38,8 +41,134 @@ def disk_offset(track, sector):
 
 
 def track_sectors(track):
-    if track > 0 and track < len(TRACK_START):
-        return TRACK_START[track] - TRACK_START[track - 1]
+    if track > 0 and track < len(TRACK_START) - 1:
+        return TRACK_START[track + 1] - TRACK_START[track]
+
+
+def image_sectors(size):
+    # the largest whole number of tracks that fits, ignoring error info
+    return max(n for n in TRACK_START if n * 256 <= size)
+
+
+LINK_END = -1
+LINK_BAD = -2
+CHAIN_LOOPS = -1
+CHAIN_BAD = -2
+Owner = namedtuple("Owner", "kind name")
+
+
+class LinkIndex:
+    def __init__(self, disk):
+        self.disk = disk
+        self.count = image_sectors(len(disk.image))
+        self.location = []
+        for track in range(1, len(TRACK_START)):
+            if TRACK_START[track] >= self.count:
+                break
+            for sector in range(track_sectors(track)):
+                self.location.append((track, sector))
+        # every link byte in the image in two strided slices
+        size = self.count * 256
+        tracks = bytes(disk.view[0:size:256])
+        sectors = bytes(disk.view[1:size:256])
+        self.next = array("h", [LINK_END] * self.count)
+        for node, (track, sector) in enumerate(zip(tracks, sectors)):
+            if track > 0:
+                self.next[node] = self.node(track, sector)
+        self.find_lengths()
+        self.owner = [None] * self.count
+        self.add_chain(Owner("bam", None), 18, 0, follow=False)
+        self.add_chain(Owner("dir", None), 18, 1)
+        for file in disk.files:
+            if file.file_type != 0:
+                owner = Owner("file", file.dos_name())
+                self.add_chain(owner, file.file_track, file.file_sector)
+
+    def node(self, track, sector):
+        # follows dump_block in letting a bad sector number spill into the
+        # next track; only links that leave the image are bad
+        if 0 < track < len(TRACK_START) and TRACK_START[track] + sector < self.count:
+            return TRACK_START[track] + sector
+        return LINK_BAD
+
+    def find_lengths(self):
+        # number of sectors until the end of the chain, or CHAIN_LOOPS /
+        # CHAIN_BAD for chains that never reach a last sector
+        self.length = array("l", [0] * self.count)
+        self.cyclic = set()
+        for start in range(self.count):
+            path = []
+            onpath = set()
+            node = start
+            while node >= 0 and self.length[node] == 0 and node not in onpath:
+                path.append(node)
+                onpath.add(node)
+                node = self.next[node]
+            if node == LINK_END:
+                tail = 0
+            elif node == LINK_BAD:
+                tail = CHAIN_BAD
+            elif node in onpath:
+                self.cyclic.update(path[path.index(node) :])
+                tail = CHAIN_LOOPS
+            else:
+                tail = self.length[node]
+            for node in reversed(path):
+                if tail >= 0:
+                    tail += 1
+                self.length[node] = tail
+
+    def chain_length(self, track, sector):
+        node = self.node(track, sector)
+        if node < 0:
+            return CHAIN_BAD
+        return self.length[node]
+
+    def chain(self, track, sector):
+        if self.chain_length(track, sector) < 0:
+            return None
+        chain = []
+        node = self.node(track, sector)
+        while node >= 0:
+            chain.append(self.location[node])
+            node = self.next[node]
+        return chain
+
+    def add_chain(self, owner, track, sector, follow=True):
+        node = self.node(track, sector)
+        visited = set()
+        while node >= 0 and node not in visited:
+            visited.add(node)
+            if self.owner[node] is None:
+                self.owner[node] = owner
+            if not follow:
+                break
+            node = self.next[node]
+
+    def chain_owner(self, track, sector):
+        node = self.node(track, sector)
+        if node >= 0:
+            return self.owner[node]
+
+    def is_cyclic(self, track, sector):
+        return self.node(track, sector) in self.cyclic
+
+    def allocated(self):
+        allocated = []
+        bam = self.disk.bam
+        for track, i in enumerate(range(0, len(bam), 4), 1):
+            bits = bam[i + 1] | bam[i + 2] << 8 | bam[i + 3] << 16
+            for sector in range(track_sectors(track)):
+                if not bits & 1 << sector:
+                    allocated.append((track, sector))
+        return allocated
+
+    def orphans(self):
+        return [
+            (track, sector)
+            for track, sector in self.allocated()
+            if self.chain_owner(track, sector) is None
+        ]
 
 
 BAM_STRUCT = "< 3B x 140s 16s 2x 5s 5x 20s 20s 44x"
@@ -110,20 +239,36 @@ class File:
 
 
 class Disk:
-    def __init__(self, filename):
+    def __init__(self, filename, use_mmap=False, metrics=None):
         self.filename = filename
+        # (track, sector) -> reason, for images that can have unreadable sectors
+        self.errors = {}
+        with stage(metrics, "load"):
+            self.image = self.load(filename, use_mmap)
+            self.view = memoryview(self.image)
+        count(metrics, "load", bytes_in=len(self.image))
+        with stage(metrics, "parse"):
+            self.parse_bam()
+            self.parse_dir()
+            self.links = LinkIndex(self)
+        count(metrics, "parse", files=len(self.files), sectors=self.links.count)
+
+    def load(self, filename, use_mmap):
         with open(filename, "rb") as f:
-            self.image = f.read()
-        self.parse_bam()
-        self.parse_dir()
+            if use_mmap:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return f.read()
 
     def dump_block(self, track, sector):
         offset = disk_offset(track, sector)
-        return self.image[offset : offset + 256]
+        return self.view[offset : offset + 256]
 
-    def dump_chain(self, track, sector, trim_link=True, trim_last=True):
-        data = b""
+    def dump_chain_view(self, track, sector, trim_link=True, trim_last=True):
+        spans = []
+        start = (track, sector)
         while track > 0:
+            if len(spans) > len(self.image) // 256:
+                raise ValueError(f"sector chain at {start[0]}/{start[1]} loops")
             block = self.dump_block(track, sector)
             track = block[0]
             sector = block[1]
@@ -131,8 +276,11 @@ class Disk:
                 block = block[: sector + 1]
             if trim_link:
                 block = block[2:]
-            data += block
-        return data
+            spans.append(block)
+        return spans
+
+    def dump_chain(self, track, sector, trim_link=True, trim_last=True):
+        return b"".join(self.dump_chain_view(track, sector, trim_link, trim_last))
 
     def parse_bam(self):
         bam = BAM._make(struct.unpack(BAM_STRUCT, self.dump_block(18, 0)))
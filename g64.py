@@ -0,0 +1,157 @@
+# Copyright (c) 2021 J.B. Langston
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import functools
+import operator
+import re
+import struct
+
+from disk import Disk, TRACK_START, disk_offset, track_sectors
+
+# Reference: https://vice-emu.sourceforge.io/vice_17.html#SEC340
+
+MAGIC = b"GCR-1541"
+HEADER_STRUCT = struct.Struct("< 8s B B H")
+GCR_CODES = (
+    0b01010, 0b01011, 0b10010, 0b10011, 0b01110, 0b01111, 0b10110, 0b10111,
+    0b01001, 0b11001, 0b11010, 0b11011, 0b01101, 0b11101, 0b11110, 0b10101,
+)  # fmt: skip
+# each byte is two five bit codes, so decoding works on ten character
+# slices of a track's bit string, looked up whole in a dict
+GCR_BYTES = {
+    f"{GCR_CODES[byte >> 4]:05b}{GCR_CODES[byte & 0xF]:05b}": byte
+    for byte in range(256)
+}
+GCR_PAIR = re.compile(r"[01]{10}")
+SYNC = re.compile(r"1{10,}")
+HEADER_MARK = 0x08
+DATA_MARK = 0x07
+HEADER_BITS = 8 * 10
+DATA_BITS = 260 * 10
+
+
+def track_bits(data):
+    # the whole track as a string of 0 and 1 characters, twice over so
+    # blocks that wrap past the end of the track can be sliced out whole
+    bits = format(int.from_bytes(data, "big"), f"0{len(data) * 8}b")
+    return bits + bits
+
+
+def gcr_decode(bits, start, count):
+    values = list(map(GCR_BYTES.get, GCR_PAIR.findall(bits, start, start + count)))
+    if len(values) * 10 != count or None in values:
+        return None
+    return bytes(values)
+
+
+def checksum(data):
+    return functools.reduce(operator.xor, data, 0)
+
+
+def decode_track(data):
+    # finds every sync mark and decodes the block after it; a data block
+    # belongs to the header block before it. returns {sector: (track,
+    # data, error)} with error None when both checksums match
+    bits = track_bits(data)
+    size = len(data) * 8
+    sectors = {}
+    header = None
+    for sync in SYNC.finditer(bits):
+        start = sync.end()
+        # past the end only the data block for a pending header matters
+        if sync.start() >= size and header is None:
+            break
+        block = gcr_decode(bits, start, 10)
+        if block is None:
+            header = None
+            continue
+        if block[0] == HEADER_MARK:
+            header = gcr_decode(bits, start, HEADER_BITS)
+        elif block[0] == DATA_MARK and header is not None:
+            _, check, sector, track = header[:4]
+            if sector not in sectors:
+                block = gcr_decode(bits, start, DATA_BITS)
+                if block is None:
+                    sectors[sector] = (track, None, "bad GCR code in data block")
+                elif check != checksum(header[2:6]):
+                    sectors[sector] = (track, block[1:257], "header checksum")
+                elif block[257] != checksum(block[1:257]):
+                    sectors[sector] = (track, block[1:257], "data checksum")
+                else:
+                    sectors[sector] = (track, block[1:257], None)
+            header = None
+    return sectors
+
+
+def read_tracks(image):
+    # maps each full track number to its raw GCR data; half tracks are
+    # skipped, as DOS never writes sectors to them
+    magic, version, count, size = HEADER_STRUCT.unpack_from(image)
+    if magic != MAGIC:
+        raise ValueError("not a G64 image")
+    offsets = struct.unpack_from(f"< {count}I", image, HEADER_STRUCT.size)
+    tracks = {}
+    for half, offset in enumerate(offsets):
+        if half & 1 or not offset:
+            continue
+        (length,) = struct.unpack_from("< H", image, offset)
+        tracks[half // 2 + 1] = image[offset + 2 : offset + 2 + length]
+    return tracks
+
+
+class G64Disk(Disk):
+    def load(self, filename, use_mmap):
+        # decodes the GCR tracks into a D64 layout, so everything that
+        # reads blocks works the same; sectors that can't be read are left
+        # zeroed and listed in errors
+        with open(filename, "rb") as f:
+            tracks = read_tracks(f.read())
+        last = 35
+        decoded = {}
+        for number, data in tracks.items():
+            if number < len(TRACK_START) - 1:
+                decoded[number] = decode_track(data)
+                if decoded[number] and number > last:
+                    last = number
+        image = bytearray(TRACK_START[last + 1] * 256)
+        for number in range(1, last + 1):
+            sectors = decoded.get(number, {})
+            for sector in range(track_sectors(number)):
+                if sector not in sectors:
+                    self.errors[number, sector] = "sector not found"
+                    continue
+                track, data, error = sectors[sector]
+                if track != number:
+                    error = f"header says track {track}"
+                if error is not None:
+                    self.errors[number, sector] = error
+                if data is not None:
+                    offset = disk_offset(number, sector)
+                    image[offset : offset + 256] = data
+        return bytes(image)
+
+
+def open_disk(filename, use_mmap=False, metrics=None):
+    with open(filename, "rb") as f:
+        magic = f.read(len(MAGIC))
+    if magic == MAGIC:
+        return G64Disk(filename, metrics=metrics)
+    return Disk(filename, use_mmap, metrics)
@@ -0,0 +1,98 @@
+# Copyright (c) 2021 J.B. Langston
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import contextlib
+import json
+import time
+
+
+class Metrics:
+    def __init__(self):
+        self.stages = {}
+        self.lengths = {}
+        self.disks = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.count(name, seconds=time.perf_counter() - start, calls=1)
+
+    def count(self, name, **counters):
+        stage = self.stages.setdefault(name, {})
+        for counter, value in counters.items():
+            stage[counter] = stage.get(counter, 0) + value
+
+    def count_decrunch(self, stats):
+        # stats come from Deboozer, replayed from the cache on a hit; there
+        # are none for entries cached before stats were kept
+        if stats is None:
+            self.count("decrunch", cache_hits=1)
+            return
+        counters = {name: value for name, value in stats.items() if name != "lengths"}
+        self.count("decrunch", streams=1, **counters)
+        for length, count in enumerate(stats["lengths"]):
+            if count:
+                self.lengths[length] = self.lengths.get(length, 0) + count
+
+    def merge(self, metrics):
+        for name, counters in metrics["stages"].items():
+            self.count(name, **counters)
+        for length, count in metrics["match_lengths"].items():
+            self.lengths[int(length)] = self.lengths.get(int(length), 0) + count
+        self.disks += metrics["disks"]
+
+    def as_dict(self):
+        return {
+            "disks": self.disks,
+            "stages": self.stages,
+            "match_lengths": {str(n): self.lengths[n] for n in sorted(self.lengths)},
+        }
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.as_dict(), f, indent=1)
+
+    def summary(self):
+        lines = []
+        for name, counters in self.stages.items():
+            counts = ", ".join(
+                f"{counter} {value}"
+                for counter, value in counters.items()
+                if counter not in ("seconds", "calls")
+            )
+            seconds = counters.get("seconds", 0)
+            lines.append(f"{name:<10} {seconds:8.3f}s  {counts}")
+        return "\n".join(lines)
+
+
+def stage(metrics, name):
+    # lets callers time a stage whether or not metrics are being collected
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name)
+
+
+def count(metrics, name, **counters):
+    if metrics is not None:
+        metrics.count(name, **counters)
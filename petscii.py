@@ -2,6 +2,9 @@
 # Authors: Linus Walleij <triad@df.lth.se>
 # General notes: Licensed under the GNU GPL, version 2
 
+import codecs
+import functools
+
 upper_chars = (
     """             \r\x0e     \x7f            !"#$%&'()*+,-./0123456789"""
     """:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\xa3]\u2191\u2190\u2500\u2660  """
@@ -47,13 +50,102 @@ def from_screencode(c):
         return c
 
 
+# when several codes show the same character, encoding picks the first
+# of them in this order: printable codes before control codes, and for
+# letters the shifted codes the keyboard types
+PETSCII_ORDER = (
+    list(range(0x20, 0x60))
+    + list(range(0xC0, 0xE0))
+    + list(range(0xA0, 0xC0))
+    + list(range(0x60, 0x80))
+    + list(range(0xE0, 0x100))
+    + list(range(0x00, 0x20))
+    + list(range(0x80, 0xA0))
+)
+# normal video before reverse
+SCREENCODE_ORDER = list(range(0x100))
+
+
+def decoding_table(chars, screencode):
+    if screencode:
+        return "".join(chars[from_screencode(c)] for c in range(256))
+    return chars
+
+
+def encoding_table(table, order):
+    encoding = {}
+    for code in order:
+        encoding.setdefault(ord(table[code]), code)
+    return encoding
+
+
+def codec_info(name, chars, screencode):
+    decoding = decoding_table(chars, screencode)
+    encoding = encoding_table(
+        decoding, SCREENCODE_ORDER if screencode else PETSCII_ORDER
+    )
+
+    def encode(input, errors="strict"):
+        return codecs.charmap_encode(input, errors, encoding)
+
+    def decode(input, errors="strict"):
+        return codecs.charmap_decode(input, errors, decoding)
+
+    class IncrementalEncoder(codecs.IncrementalEncoder):
+        def encode(self, input, final=False):
+            return encode(input, self.errors)[0]
+
+    class IncrementalDecoder(codecs.IncrementalDecoder):
+        def decode(self, input, final=False):
+            return decode(input, self.errors)[0]
+
+    class StreamWriter(codecs.StreamWriter):
+        pass
+
+    class StreamReader(codecs.StreamReader):
+        pass
+
+    StreamWriter.encode = staticmethod(encode)
+    StreamReader.decode = staticmethod(decode)
+    return codecs.CodecInfo(
+        name=name,
+        encode=encode,
+        decode=decode,
+        incrementalencoder=IncrementalEncoder,
+        incrementaldecoder=IncrementalDecoder,
+        streamwriter=StreamWriter,
+        streamreader=StreamReader,
+    )
+
+
+CODECS = {
+    "petscii-upper": (upper_chars, False),
+    "petscii-lower": (lower_chars, False),
+    "screencode-upper": (upper_chars, True),
+    "screencode-lower": (lower_chars, True),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def search(name):
+    name = name.replace("_", "-")
+    if name in CODECS:
+        return codec_info(name, *CODECS[name])
+    return None
+
+
+codecs.register(search)
+
+
+def codec_name(lower=True, screencode=False):
+    kind = "screencode" if screencode else "petscii"
+    case = "lower" if lower else "upper"
+    return f"{kind}-{case}"
+
+
 def to_unicode(bytes, lower=True, screencode=False):
-    unicode = ""
-    for b in bytes:
-        if screencode:
-            b = from_screencode(b)
-        if lower:
-            unicode += lower_chars[b]
-        else:
-            unicode += upper_chars[b]
-    return unicode
\ No newline at end of file
+    return codecs.decode(bytes, codec_name(lower, screencode))
+
+
+def from_unicode(text, lower=True, screencode=False, errors="strict"):
+    return codecs.encode(text, codec_name(lower, screencode), errors)
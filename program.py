@@ -1,7 +1,17 @@
 import petscii
-import bisect
+import sys
+from array import array
+from bisect import bisect_left
+from collections import deque, namedtuple
+from symbols import SymbolTable
 from util import to_word, to_bytes
 
+# what owns each address in State.kinds
+FREE = 0
+CODE = 1
+DATA = 2
+BASIC = 3
+
 # fmt: off
 basic_tokens = (
     "END", "FOR", "NEXT", "DATA", "INPUT#", "INPUT", "DIM", "READ", "LET",
@@ -35,14 +45,8 @@ operand_formats = {
 }
 # fmt: on
 
-class Opcode:
-    def __init__(self, mnemonic, mode, length, cycles, variable, undocumented):
-        self.mnemonic = mnemonic
-        self.mode = mode
-        self.length = length
-        self.cycles = cycles
-        self.variable = variable
-        self.undocumented = undocumented
+# immutable, and without a dict per opcode
+Opcode = namedtuple("Opcode", "mnemonic mode length cycles variable undocumented")
 
 opcodes = (
     Opcode("brk", "s", 2, 7, False, False),
@@ -305,39 +309,71 @@ opcodes = (
 
 
 class AsmInstr:
+    # a view of an instruction: its address, opcode byte and the raw word
+    # or byte after it, as stored in the columns of State
+    __slots__ = ("addr", "op", "arg")
+    kind = CODE
+
     def __init__(self, addr, data):
         self.addr = addr
-        self.bytes = bytes(data)
-        self.opcode = opcodes[data[0]]
+        self.op = data[0]
         if len(data) == 3:
-            self.operand = to_word(data[1:])
+            self.arg = to_word(data[1:])
         elif len(data) == 2:
-            self.operand = self.bytes[1]
-            if self.opcode.mode == "r":
-                if self.operand & 0x80:
-                    self.operand = (self.operand & 0x7F) - 0x80
-                self.operand += self.addr
+            self.arg = data[1]
         else:
-            self.operand = None
+            self.arg = 0
+
+    @classmethod
+    def view(cls, addr, op, arg):
+        instr = cls.__new__(cls)
+        instr.addr = addr
+        instr.op = op
+        instr.arg = arg
+        return instr
+
+    @property
+    def opcode(self):
+        return opcodes[self.op]
+
+    @property
+    def bytes(self):
+        length = opcodes[self.op].length
+        return bytes((self.op, self.arg & 0xFF, self.arg >> 8)[:length])
+
+    @property
+    def operand(self):
+        opcode = opcodes[self.op]
+        if opcode.length == 1:
+            return None
+        if opcode.mode == "r":
+            # branches are relative to the following instruction
+            offset = self.arg - 0x100 if self.arg & 0x80 else self.arg
+            return (self.addr + 2 + offset) & 0xFFFF
+        return self.arg
 
     def format(self, symbols=None, lower=True, addr=True, bytes=True):
-        if self.operand is not None:
-            if symbols and self.operand in symbols:
-                sym = symbols[self.operand]
-            else:
-                if self.opcode.length == 2:
-                    if self.opcode.mode == "r":
-                        sym = f"${self.operand:04x}"
+        opcode = opcodes[self.op]
+        operand = self.operand
+        if operand is not None:
+            # symbols can be a dict or a SymbolTable; immediates are values
+            sym = None
+            if symbols and opcode.mode != "#":
+                sym = symbols.get(operand)
+            if sym is None:
+                if opcode.length == 2:
+                    if opcode.mode == "r":
+                        sym = f"${operand:04x}"
                     else:
-                        sym = f"${self.operand:02x}"
-                elif self.opcode.length == 3:
-                    sym = f"${self.operand:04x}"
+                        sym = f"${operand:02x}"
+                elif opcode.length == 3:
+                    sym = f"${operand:04x}"
                 if not lower:
                     sym = sym.upper()
         else:
             sym = ""
-        nem = self.opcode.mnemonic
-        fmt = operand_formats[self.opcode.mode]
+        nem = opcode.mnemonic
+        fmt = operand_formats[opcode.mode]
         if not lower:
             nem = nem.upper()
             fmt = fmt.upper()
@@ -361,6 +397,8 @@ class AsmInstr:
 
 
 class BasicLine:
+    kind = BASIC
+
     def __init__(self, addr, bytes):
         self.addr = addr
         self.bytes = bytes
@@ -407,14 +445,16 @@ class BasicLine:
         return self.addr < other.addr
 
 class Data:
+    kind = DATA
+
     def __init__(self, addr, bytes):
         self.addr = addr
         self.bytes = bytes
 
     def format(self):
         lines = []
-        for i in range(len(0, self.data), 16):
-            lines.append(f"{self.addr+i}  {self.data[i:i+16].hex(' ')}")
+        for i in range(0, len(self.bytes), 16):
+            lines.append(f"{self.addr+i:04x}  {self.bytes[i:i+16].hex(' ')}")
         return "\n".join(lines)
 
     def __str__(self):
@@ -425,16 +465,418 @@ class Data:
 
 branchops = {'bvs', 'bcs', 'beq', 'bmi', 'bcc', 'bne', 'bpl', 'bvc', 'jsr'}
 
+# flags in DecodeTable.flags
+UNDOCUMENTED = 0x01
+STOP = 0x02      # tracing doesn't continue past rts, rti, brk and jam
+BRANCH = 0x04    # conditional branches and jsr: both paths are traced
+JUMP = 0x08      # jmp absolute: continues at the target
+INDIRECT = 0x10  # jmp indirect: continues at the address stored at operand
+
+
+def opcode_flags(op):
+    flags = 0
+    if op.undocumented:
+        flags |= UNDOCUMENTED
+    if op.mnemonic in ("rts", "rti", "brk", "jam"):
+        flags |= STOP
+    if op.mnemonic in branchops:
+        flags |= BRANCH
+    if op.mnemonic == "jmp":
+        flags |= JUMP if op.mode == "a" else INDIRECT
+    return flags
+
+
+OPCODE_LENGTHS = bytes(op.length for op in opcodes)
+OPCODE_FLAGS = bytes(opcode_flags(op) for op in opcodes)
+
+
+def opcode_mask(test):
+    return bytes(0xFF if test(op) else 0 for op in opcodes)
+
+
+# masks by opcode byte that pick each instruction's operand and target
+NO_OPERAND = opcode_mask(lambda op: op.length == 1)
+BYTE_OPERAND = opcode_mask(lambda op: op.length == 2)
+WORD_OPERAND = opcode_mask(lambda op: op.length == 3)
+RELATIVE = opcode_mask(lambda op: op.mode == "r")
+ABSOLUTE = opcode_mask(
+    lambda op: op.length == 3 and opcode_flags(op) & (BRANCH | JUMP)
+)
+NO_TARGET = bytes(~(r | a) & 0xFF for r, a in zip(RELATIVE, ABSOLUTE))
+# a relative offset with its sign bit flipped is the offset plus 0x80
+SIGN_FLIP = bytes(b ^ 0x80 for b in range(256))
+
+
+def lanes(count, *planes):
+    # the items of an array("i") as one integer, so masks and sums apply to
+    # every item at once; planes are the bytes of each item, low byte first
+    items = bytearray(4 * count)
+    for i, plane in enumerate(planes):
+        items[i if sys.byteorder == "little" else 3 - i :: 4] = plane
+    return int.from_bytes(items, sys.byteorder)
+
+
+def mask_lanes(mask):
+    # a byte mask over all four bytes of each item
+    return lanes(len(mask), mask, mask, mask, mask)
+
+
+# addr - 126 + 64K for every address, as the base of relative targets
+RELATIVE_BASE = array("i", range(0x10000 - 126, 0x20000 - 126)).tobytes()
+
+
+def from_lanes(value, count):
+    items = array("i")
+    items.frombytes(value.to_bytes(4 * count, sys.byteorder))
+    return items
+
+
+class DecodeTable:
+    # every address decoded as if an instruction started there: length,
+    # flags, operand and branch or jump target, or -1 where there is none
+    def __init__(self, mem):
+        self.mem = mem
+        size = len(mem)
+        self.lengths = bytearray(size)
+        self.flags = bytearray(size)
+        self.operands = array("i", [-1]) * size
+        self.targets = array("i", [-1]) * size
+        self.update(0, size)
+
+    def update(self, start, end):
+        # instructions starting up to two bytes before start read into it
+        mem = self.mem
+        size = len(mem)
+        start = max(start - 2, 0)
+        end = min(end, size)
+        ops = bytes(mem[start:end])
+        self.lengths[start:end] = ops.translate(OPCODE_LENGTHS)
+        self.flags[start:end] = ops.translate(OPCODE_FLAGS)
+        # operands and targets are worked out for the whole range at once,
+        # from the bytes after each address
+        count = end - start
+        after = bytes(mem[start + 1 : end + 2]).ljust(count + 1, b"\0")
+        word = lanes(count, after[:count], after[1:])
+        byte = lanes(count, after[:count])
+        operands = (
+            word & mask_lanes(ops.translate(WORD_OPERAND))
+            | byte & mask_lanes(ops.translate(BYTE_OPERAND))
+            | mask_lanes(ops.translate(NO_OPERAND))
+        )
+        # relative targets are addr + 2 + offset, or addr - 126 plus the
+        # offset with its sign flipped, kept positive by adding 64K
+        base = int.from_bytes(RELATIVE_BASE[4 * start : 4 * end], sys.byteorder)
+        offsets = lanes(count, after[:count].translate(SIGN_FLIP))
+        low_word = lanes(count, b"\xff" * count, b"\xff" * count)
+        targets = (
+            (base + offsets) & low_word & mask_lanes(ops.translate(RELATIVE))
+            | word & mask_lanes(ops.translate(ABSOLUTE))
+            | mask_lanes(ops.translate(NO_TARGET))
+        )
+        self.operands[start:end] = from_lanes(operands, count)
+        self.targets[start:end] = from_lanes(targets, count)
+
+    def sweep(self, start, end):
+        # addresses of instructions in a linear sweep from start
+        addrs = []
+        lengths = self.lengths
+        addr = start
+        while addr < end:
+            addrs.append(addr)
+            addr += lengths[addr]
+        return addrs
+
+    def xrefs(self, addrs):
+        # maps each branch or jump target to the instructions that use it
+        refs = {}
+        targets = self.targets
+        for addr in addrs:
+            target = targets[addr]
+            if target >= 0:
+                refs.setdefault(target, []).append(addr)
+        return refs
+
+
+class CodeBlock:
+    # a basic block: instructions that are only entered at addr and only
+    # left after the last one
+    def __init__(self, addr):
+        self.addr = addr
+        self.end = addr
+        self.instrs = []
+        # edges as (block address, kind) and (target address, kind), where
+        # kind is fallthrough, branch, jsr or jmp
+        self.preds = set()
+        self.succs = set()
+
+    def __lt__(self, other):
+        return self.addr < other.addr
+
+
+def pending_order(edge):
+    # entries have no instruction, and go first
+    source, kind = edge
+    return -1 if source is None else source, kind
+
+
+class ControlFlow:
+    # traces code from entry points into basic blocks, and retraces only the
+    # blocks affected when an entry is added or a range is marked as data
+    def __init__(self, state, undocumented=False):
+        self.state = state
+        self.undocumented = undocumented
+        self.entries = set()
+        self.nodes = {}
+        # targets that couldn't be traced, e.g. because they land inside
+        # another instruction, with the (instruction, kind) edges to them;
+        # they are tried again when their bytes are freed
+        self.pending = {}
+        # address of the basic block that owns each byte, or -1
+        self.owner = array("i", [-1]) * len(state.mem)
+
+    def add_entry(self, addr):
+        self.entries.add(addr)
+        self.trace([(addr, None, "entry")])
+
+    def mark_data(self, start, end):
+        # only the blocks in the range are retraced, from the edges into
+        # them; blocks that can't be reached from an entry after that go too
+        work, orphans = self.remove(set(self.owner[start:end]) - {-1})
+        self.state.remove_objects(start, end)
+        self.state.insert_block(Data(start, bytes(self.state.mem[start:end])))
+        self.trace(work)
+        dead = self.unreachable()
+        if dead:
+            freed, lost = self.remove(dead)
+            self.trace(freed)
+            work += freed
+            orphans |= lost
+        # blocks retraced from an edge that is now a plain fallthrough, or
+        # left with one, are joined to the block before them again
+        targets = orphans | {target for target, source, kind in work}
+        for addr in sorted(targets, reverse=True):
+            self.join(addr)
+
+    def trace(self, work):
+        # each item is a target, the instruction that leads there and the
+        # kind of edge; the instruction is looked up again when the item is
+        # taken, since its block may have been split in the meantime
+        work = deque(work)
+        while work:
+            target, source, kind = work.popleft()
+            node = self.node_at(target)
+            if node is None:
+                node = self.build(target, work)
+            if node is None:
+                if kind == "fallthrough" and not self.falls_through(source):
+                    # a block that ran into code which is gone now just ends
+                    self.nodes[self.owner[source]].succs.discard((target, kind))
+                else:
+                    self.pending.setdefault(target, set()).add((source, kind))
+            elif source is not None:
+                node.preds.add((self.owner[source], kind))
+
+    def falls_through(self, source):
+        # fallthrough edges after branches and jsr are always there; other
+        # blocks only fall through because they ran into a traced block
+        return self.state.decoded.flags[source] & BRANCH
+
+    def node_at(self, addr):
+        start = self.owner[addr]
+        if start < 0 or self.state.starts[addr] < 0:
+            return None
+        node = self.nodes[start]
+        return node if start == addr else self.split(node, addr)
+
+    def build(self, addr, work):
+        state = self.state
+        mem = state.mem
+        decoded = state.decoded
+        lengths = decoded.lengths
+        flags = decoded.flags
+        skip = 0 if self.undocumented else UNDOCUMENTED
+        node = CodeBlock(addr)
+        while True:
+            next = addr + lengths[addr]
+            flag = flags[addr]
+            if flag & skip or next > len(mem) or not state.is_free(addr, next):
+                # running into code that is already traced joins its block
+                if node.instrs and self.owner[addr] >= 0 and state.starts[addr] >= 0:
+                    node.succs.add((addr, "fallthrough"))
+                break
+            state.insert_instr(addr, next)
+            node.instrs.append(addr)
+            node.end = next
+            if flag & STOP:
+                break
+            if flag & JUMP:
+                node.succs.add((decoded.targets[addr], "jmp"))
+                break
+            if flag & INDIRECT:
+                # the pointer doesn't carry into the high byte on a 6502
+                pointer = decoded.operands[addr]
+                high = pointer & 0xFF00 | (pointer + 1) & 0xFF
+                node.succs.add((mem[pointer] | mem[high] << 8, "jmp"))
+                break
+            if flag & BRANCH:
+                kind = "jsr" if mem[addr] == 0x20 else "branch"
+                node.succs.add((decoded.targets[addr], kind))
+                if next < len(mem):
+                    node.succs.add((next, "fallthrough"))
+                break
+            addr = next
+        if not node.instrs:
+            return None
+        self.nodes[node.addr] = node
+        self.owner[node.addr:node.end] = array("i", [node.addr]) * (
+            node.end - node.addr
+        )
+        last = node.instrs[-1]
+        work.extend((target, last, kind) for target, kind in sorted(node.succs))
+        return node
+
+    def split(self, node, addr):
+        i = bisect_left(node.instrs, addr)
+        tail = CodeBlock(addr)
+        tail.instrs = node.instrs[i:]
+        tail.end = node.end
+        tail.succs = node.succs
+        tail.preds = {(node.addr, "fallthrough")}
+        del node.instrs[i:]
+        node.end = addr
+        node.succs = {(addr, "fallthrough")}
+        for target, kind in tail.succs:
+            if target in self.nodes:
+                preds = self.nodes[target].preds
+                preds.discard((node.addr, kind))
+                preds.add((addr, kind))
+        self.nodes[addr] = tail
+        self.owner[addr:tail.end] = array("i", [addr]) * (tail.end - addr)
+        return tail
+
+    def unreachable(self):
+        # blocks that no path from an entry leads to
+        seen = set()
+        stack = [addr for addr in self.entries if addr in self.nodes]
+        while stack:
+            addr = stack.pop()
+            if addr not in seen:
+                seen.add(addr)
+                stack.extend(
+                    target
+                    for target, kind in self.nodes[addr].succs
+                    if target in self.nodes
+                )
+        return self.nodes.keys() - seen
+
+    def remove(self, starts):
+        # drops the blocks, and returns the edges and entries from outside
+        # that lead back in, and the blocks left that lost an edge into them
+        removed = {start: self.nodes.pop(start) for start in starts}
+        orphans = set()
+        work = []
+        for start, node in sorted(removed.items()):
+            for addr in node.instrs:
+                self.state.remove_block(addr)
+            self.owner[node.addr:node.end] = array("i", [-1]) * (
+                node.end - node.addr
+            )
+            if start in self.entries:
+                work.append((start, None, "entry"))
+            for pred, kind in sorted(node.preds):
+                if pred not in removed:
+                    work.append((start, self.nodes[pred].instrs[-1], kind))
+            for target, kind in node.succs:
+                if target in self.nodes:
+                    self.nodes[target].preds.discard((start, kind))
+                    orphans.add(target)
+        # edges from the removed blocks come back when they are retraced;
+        # the rest are tried again if their target's bytes are now free
+        pending = self.pending
+        self.pending = {}
+        for target, edges in sorted(pending.items()):
+            edges = {
+                (source, kind)
+                for source, kind in edges
+                if source is None or self.owner[source] >= 0
+            }
+            if not edges:
+                continue
+            if self.state.is_free(target, target + 1):
+                work.extend(
+                    (target, source, kind)
+                    for source, kind in sorted(edges, key=pending_order)
+                )
+            else:
+                self.pending[target] = edges
+        return work, orphans
+
+    def join(self, addr):
+        # merges a block back into the one before it once the only edge
+        # into it is the fallthrough, undoing a split nothing needs any more
+        node = self.nodes.get(addr)
+        if node is None or addr in self.entries or len(node.preds) != 1:
+            return
+        (start, kind), = node.preds
+        head = self.nodes[start]
+        if kind != "fallthrough" or head.succs != {(addr, "fallthrough")}:
+            return
+        del self.nodes[addr]
+        head.instrs += node.instrs
+        head.end = node.end
+        head.succs = node.succs
+        for target, kind in node.succs:
+            if target in self.nodes:
+                preds = self.nodes[target].preds
+                preds.discard((addr, kind))
+                preds.add((start, kind))
+        self.owner[addr:node.end] = array("i", [start]) * (node.end - addr)
+
+    def blocks(self):
+        return sorted(self.nodes.values())
+
+
 class State:
-    def __init__(self):
-        self.mem = bytearray(64*1024)
-        self.claimed = set()
-        self.blocks = []
+    def __init__(self, mem=None):
+        self.mem = bytearray(64*1024) if mem is None else bytearray(mem)
+        # per address: the id of the block that owns it and its kind, so
+        # checking whether an address is taken is a single array read
+        self.owners = array("i", [-1]) * (64*1024)
+        self.kinds = bytearray(64*1024)
+        # ids of the blocks starting at each address
+        self.starts = array("i", [-1]) * (64*1024)
+        # instructions by id in columns; other blocks are kept as objects
+        # and leave an empty row
+        self.instr_addrs = array("i")
+        self.instr_ops = bytearray()
+        self.instr_args = array("H")
+        self.objects = {}
+        self.decoded = DecodeTable(self.mem)
+        self.flow = ControlFlow(self)
+
+    @property
+    def blocks(self):
+        return [self.block(id) for id in self.starts if id >= 0]
+
+    def block(self, id):
+        if id in self.objects:
+            return self.objects[id]
+        return AsmInstr.view(
+            self.instr_addrs[id], self.instr_ops[id], self.instr_args[id]
+        )
+
+    def block_at(self, addr):
+        owner = self.owners[addr]
+        return self.block(owner) if owner >= 0 else None
+
+    def is_free(self, start, end):
+        return not any(self.kinds[start:end])
 
     def load_prg(self, data):
         load = to_word(data)
         data = data[2:]
         self.mem[load:load+len(data)] = data
+        self.decoded.update(load, load+len(data))
         if load == 0x801:
             self.parse_basic(0x801)
         
@@ -462,35 +904,155 @@ class State:
                 break
 
     def trace_asm(self, start):
-        heads = set()
-        next = start
-        while True:
-            op = opcodes[self.mem[next]]
-            instr = AsmInstr(next, self.mem[next:next+op.length])
-            next += op.length
-            instaddrs = set(range(instr.addr, next))
-            if (
-                op.mnemonic in ("rts", "brk") or 
-                op.undocumented or 
-                self.claimed & instaddrs
-            ):
-                if len(heads) > 0:
-                    next = heads.pop()
-                else:
-                    break
-            else:
-                self.claimed.update(instaddrs)
-                self.insert_block(instr)
-                if op.mnemonic == "jmp":
-                    if op.mode == "a":
-                        next = instr.operand
-                    elif op.mode == "i":
-                        next = to_word(self.mem[instr.operand])
-                elif op.mnemonic in branchops:
-                    heads.add(instr.operand)
+        self.flow.add_entry(start)
+
+    def mark_data(self, start, end):
+        self.flow.mark_data(start, end)
 
     def insert_block(self, block):
-        bisect.insort_right(self.blocks, block)
+        id = len(self.instr_addrs)
+        if block.kind == CODE:
+            self.add_row(block.addr, block.op, block.arg)
+        else:
+            self.add_row(-1, 0, 0)
+            self.objects[id] = block
+        self.claim(id, block.addr, block.addr + len(block.bytes), block.kind)
+
+    def insert_instr(self, addr, end):
+        # an instruction from memory, without making a view of it
+        id = len(self.instr_addrs)
+        self.add_row(addr, self.mem[addr], max(self.decoded.operands[addr], 0))
+        self.claim(id, addr, end, CODE)
+
+    def add_row(self, addr, op, arg):
+        self.instr_addrs.append(addr)
+        self.instr_ops.append(op)
+        self.instr_args.append(arg)
+
+    def claim(self, id, start, end, kind):
+        end = min(end, len(self.mem))
+        self.starts[start] = id
+        self.owners[start:end] = array("i", [id]) * (end - start)
+        self.kinds[start:end] = bytes([kind]) * (end - start)
+
+    def remove_block(self, addr):
+        id = self.starts[addr]
+        self.starts[addr] = -1
+        if id in self.objects:
+            length = len(self.objects.pop(id).bytes)
+        else:
+            length = opcodes[self.instr_ops[id]].length
+            self.instr_addrs[id] = -1
+        end = min(addr + length, len(self.mem))
+        self.owners[addr:end] = array("i", [-1]) * (end - addr)
+        self.kinds[addr:end] = bytes(end - addr)
+
+    def remove_objects(self, start, end):
+        # frees [start, end) of data blocks and BASIC lines; data blocks
+        # keep their bytes outside the range, but a cut BASIC line is
+        # dropped, since what is left of it can't be listed
+        for id in sorted(set(self.owners[start:end]) - {-1}):
+            block = self.objects.get(id)
+            if block is None:
+                continue
+            self.remove_block(block.addr)
+            if block.kind == DATA:
+                stop = block.addr + len(block.bytes)
+                if block.addr < start:
+                    head = block.bytes[: start - block.addr]
+                    self.insert_block(Data(block.addr, head))
+                if stop > end:
+                    self.insert_block(Data(end, block.bytes[end - block.addr :]))
 
     def __str__(self):
-        return "\n".join(str(b) for b in self.blocks)
\ No newline at end of file
+        return "\n".join(str(b) for b in self.blocks)
+
+class Listing:
+    # formatted lines for a window of addresses; the lines of each block are
+    # cached until its symbols, comment or the formatting options change
+    def __init__(
+        self, state, symbols=None, comments=None, lower=True, addr=True, bytes=True
+    ):
+        self.state = state
+        self.symbols = SymbolTable(symbols or ())
+        self.comments = dict(comments or {})
+        self.options = dict(lower=lower, addr=addr, bytes=bytes)
+        # lines by block address, with the block id and options they came from
+        self.cache = {}
+        # addresses of the cached blocks that use each operand
+        self.users = {}
+
+    def set_options(self, **options):
+        # cached lines made with other options are replaced when drawn
+        self.options = {**self.options, **options}
+
+    def set_symbol(self, addr, name, length=1):
+        # operands anywhere in the old or new range of the symbol change
+        old = self.symbols.remove(addr)
+        if name is not None:
+            self.symbols.add(addr, name, length)
+        self.invalidate(addr)
+        for operand in range(addr, addr + max(old, length)):
+            for user in self.users.pop(operand, ()):
+                self.invalidate(user)
+
+    def set_comment(self, addr, text):
+        if text is None:
+            self.comments.pop(addr, None)
+        else:
+            self.comments[addr] = text
+        self.invalidate(addr)
+
+    def invalidate(self, addr):
+        block = self.state.block_at(addr)
+        if block is not None:
+            self.cache.pop(block.addr, None)
+
+    def block_lines(self, addr, id):
+        # cached lines are kept while the same block id starts at addr
+        cached = self.cache.get(addr)
+        if cached is not None and cached[0] == id and cached[1] == self.options:
+            return cached[2]
+        lines = self.format(self.state.block(id))
+        self.cache[addr] = id, self.options, lines
+        return lines
+
+    def format(self, block):
+        options = self.options
+        if block.kind == CODE:
+            lines = [block.format(self.symbols, **options)]
+            if block.operand is not None:
+                self.users.setdefault(block.operand, set()).add(block.addr)
+        elif block.kind == BASIC:
+            lines = [block.format(options["lower"])]
+        else:
+            lines = block.format().split("\n")
+        comment = self.comments.get(block.addr)
+        if comment is not None:
+            lines[0] += f"  ; {comment}"
+        label = self.symbols.label(block.addr)
+        if label is not None:
+            lines.insert(0, f"{label}:")
+        return lines
+
+    def window(self, start, end):
+        # lines of the blocks that start in [start, end)
+        lines = []
+        starts = self.state.starts
+        for addr in range(start, min(end, len(starts))):
+            id = starts[addr]
+            if id >= 0:
+                lines.extend(self.block_lines(addr, id))
+        return lines
+
+    def page(self, start, count):
+        # count lines from the first block at or after start, for scrolling
+        lines = []
+        starts = self.state.starts
+        addr = start
+        while len(lines) < count and addr < len(starts):
+            id = starts[addr]
+            if id >= 0:
+                lines.extend(self.block_lines(addr, id))
+            addr += 1
+        return lines[:count]
@@ -0,0 +1,312 @@
+# Copyright (c) 2021 J.B. Langston
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import sqlite3
+import sys
+from array import array
+from bisect import bisect_left
+
+from program import AsmInstr, BasicLine, CodeBlock, Data, State, CODE, DATA, BASIC
+from symbols import SymbolTable
+
+SCHEMA = """
+create table if not exists parts (
+    id integer primary key,
+    name text not null unique,
+    memory blob not null
+);
+create table if not exists blocks (
+    part integer not null,
+    addr integer not null,
+    end integer not null,
+    kind integer not null,
+    primary key (part, addr)
+) without rowid;
+create table if not exists nodes (
+    part integer not null,
+    addr integer not null,
+    end integer not null,
+    primary key (part, addr)
+) without rowid;
+create table if not exists xrefs (
+    part integer not null,
+    source integer not null,
+    target integer not null,
+    kind text not null
+);
+create index if not exists xrefs_source on xrefs (part, source);
+create index if not exists xrefs_target on xrefs (part, target);
+create table if not exists columns (
+    part integer primary key,
+    owners blob not null,
+    kinds blob not null,
+    starts blob not null,
+    instr_addrs blob not null,
+    instr_ops blob not null,
+    instr_args blob not null,
+    flow blob not null
+);
+create table if not exists entries (
+    part integer not null,
+    addr integer not null,
+    primary key (part, addr)
+) without rowid;
+create table if not exists symbols (
+    part integer not null,
+    addr integer not null,
+    name text not null,
+    length integer not null default 1,
+    primary key (part, addr)
+) without rowid;
+create index if not exists symbols_name on symbols (part, name);
+create table if not exists comments (
+    part integer not null,
+    addr integer not null,
+    text text not null,
+    primary key (part, addr)
+) without rowid;
+"""
+
+BLOCK_TYPES = {CODE: AsmInstr, DATA: Data, BASIC: BasicLine}
+
+
+def pack(column):
+    # arrays are stored little endian, so a project opens on any machine
+    if sys.byteorder == "big":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def unpack(typecode, blob):
+    column = array(typecode)
+    column.frombytes(blob)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+
+class Project:
+    # a disassembly project with one memory image per part, e.g. each file
+    # of a trackmo; blocks, symbols and comments are read back one address
+    # window at a time
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute("pragma journal_mode = wal")
+        self.db.execute("pragma synchronous = normal")
+        self.db.executescript(SCHEMA)
+        self.images = {}
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def parts(self):
+        return [name for name, in self.db.execute("select name from parts order by id")]
+
+    def part_id(self, name):
+        row = self.db.execute("select id from parts where name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row[0]
+
+    def save(self, name, state, symbols=None, comments=None):
+        # replaces the whole part in one transaction
+        flow = state.flow
+        blocks = [
+            (b.addr, min(b.addr + len(b.bytes), len(state.mem)), b.kind)
+            for b in state.blocks
+        ]
+        nodes = [(n.addr, n.end) for n in flow.blocks()]
+        xrefs = [
+            (n.instrs[-1], target, kind)
+            for n in flow.blocks()
+            for target, kind in sorted(n.succs)
+        ]
+        with self.db:
+            self.db.execute(
+                "insert into parts (name, memory) values (?, ?) "
+                "on conflict (name) do update set memory = excluded.memory",
+                (name, bytes(state.mem)),
+            )
+            part = self.part_id(name)
+            for table in ("blocks", "columns", "nodes", "xrefs", "entries"):
+                self.db.execute(f"delete from {table} where part = ?", (part,))
+            self.db.executemany(
+                "insert into blocks values (?, ?, ?, ?)",
+                ((part, *block) for block in blocks),
+            )
+            # the state's own columns, so load doesn't rebuild them per block
+            self.db.execute(
+                "insert into columns values (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    part,
+                    pack(state.owners),
+                    bytes(state.kinds),
+                    pack(state.starts),
+                    pack(state.instr_addrs),
+                    bytes(state.instr_ops),
+                    pack(state.instr_args),
+                    pack(flow.owner),
+                ),
+            )
+            self.db.executemany(
+                "insert into nodes values (?, ?, ?)", ((part, *n) for n in nodes)
+            )
+            self.db.executemany(
+                "insert into xrefs values (?, ?, ?, ?)", ((part, *x) for x in xrefs)
+            )
+            self.db.executemany(
+                "insert into entries values (?, ?)",
+                ((part, addr) for addr in sorted(flow.entries)),
+            )
+            if symbols is not None:
+                self._write_symbols(part, symbols)
+            if comments is not None:
+                self._write_comments(part, comments)
+        self.images[name] = bytes(state.mem)
+
+    def set_symbols(self, name, symbols):
+        with self.db:
+            self._write_symbols(self.part_id(name), symbols)
+
+    def set_comments(self, name, comments):
+        with self.db:
+            self._write_comments(self.part_id(name), comments)
+
+    # these don't commit, so callers can put them in a larger transaction
+
+    def _write_symbols(self, part, symbols):
+        self.db.execute("delete from symbols where part = ?", (part,))
+        self.db.executemany(
+            "insert into symbols values (?, ?, ?, ?)",
+            ((part, *symbol) for symbol in SymbolTable(symbols).items()),
+        )
+
+    def _write_comments(self, part, comments):
+        self.db.execute("delete from comments where part = ?", (part,))
+        self.db.executemany(
+            "insert into comments values (?, ?, ?)",
+            ((part, addr, text) for addr, text in sorted(comments.items())),
+        )
+
+    def memory(self, name):
+        if name not in self.images:
+            row = self.db.execute(
+                "select memory from parts where name = ?", (name,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(name)
+            self.images[name] = row[0]
+        return self.images[name]
+
+    def window(self, name, start, end):
+        # blocks that start in [start, end), built from the stored memory
+        mem = self.memory(name)
+        rows = self.db.execute(
+            "select addr, end, kind from blocks "
+            "where part = ? and addr >= ? and addr < ? order by addr",
+            (self.part_id(name), start, end),
+        )
+        return [BLOCK_TYPES[kind](addr, mem[addr:stop]) for addr, stop, kind in rows]
+
+    def symbols(self, name, start=0, end=0x10000):
+        # symbols that cover any address in [start, end)
+        return SymbolTable(
+            self.db.execute(
+                "select addr, name, length from symbols "
+                "where part = ? and addr < ? and addr + length > ?",
+                (self.part_id(name), end, start),
+            )
+        )
+
+    def comments(self, name, start=0, end=0x10000):
+        return dict(
+            self.db.execute(
+                "select addr, text from comments "
+                "where part = ? and addr >= ? and addr < ?",
+                (self.part_id(name), start, end),
+            )
+        )
+
+    def xrefs(self, name, target):
+        # instructions that branch or jump to target
+        return self.db.execute(
+            "select source, kind from xrefs where part = ? and target = ? "
+            "order by source",
+            (self.part_id(name), target),
+        ).fetchall()
+
+    def load(self, name):
+        # restores the state's columns as they were saved, so no object is
+        # made per instruction and nothing is traced again
+        part = self.part_id(name)
+        mem = self.memory(name)
+        state = State(mem)
+        flow = state.flow
+        owners, kinds, starts, addrs, ops, args, owner = self.db.execute(
+            "select owners, kinds, starts, instr_addrs, instr_ops, instr_args, "
+            "flow from columns where part = ?",
+            (part,),
+        ).fetchone()
+        state.owners = unpack("i", owners)
+        state.kinds = bytearray(kinds)
+        state.starts = unpack("i", starts)
+        state.instr_addrs = unpack("i", addrs)
+        state.instr_ops = bytearray(ops)
+        state.instr_args = unpack("H", args)
+        flow.owner = unpack("i", owner)
+        for addr, end, kind in self.db.execute(
+            "select addr, end, kind from blocks where part = ? and kind != ?",
+            (part, CODE),
+        ):
+            state.objects[state.starts[addr]] = BLOCK_TYPES[kind](addr, mem[addr:end])
+        code = sorted(addr for addr in state.instr_addrs if addr >= 0)
+        for addr, end in self.db.execute(
+            "select addr, end from nodes where part = ?", (part,)
+        ):
+            node = CodeBlock(addr)
+            node.end = end
+            node.instrs = code[bisect_left(code, addr) : bisect_left(code, end)]
+            flow.nodes[addr] = node
+        for source, target, kind in self.db.execute(
+            "select source, target, kind from xrefs where part = ?", (part,)
+        ):
+            start = flow.owner[source]
+            flow.nodes[start].succs.add((target, kind))
+            if target in flow.nodes:
+                flow.nodes[target].preds.add((start, kind))
+            else:
+                flow.pending.setdefault(target, set()).add((source, kind))
+        flow.entries.update(
+            addr
+            for addr, in self.db.execute(
+                "select addr from entries where part = ?", (part,)
+            )
+        )
+        for addr in flow.entries - flow.nodes.keys():
+            flow.pending.setdefault(addr, set()).add((None, "entry"))
+        return state
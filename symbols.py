@@ -0,0 +1,236 @@
+# Copyright (c) 2021 J.B. Langston
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+# built in symbols as (address, name, length)
+# fmt: off
+KERNAL = (
+    (0x0000, "D6510", 1), (0x0001, "R6510", 1),
+    (0x0314, "CINV", 2), (0x0316, "CBINV", 2), (0x0318, "NMINV", 2),
+    (0xFF81, "CINT", 1), (0xFF84, "IOINIT", 1), (0xFF87, "RAMTAS", 1),
+    (0xFF8A, "RESTOR", 1), (0xFF8D, "VECTOR", 1), (0xFF90, "SETMSG", 1),
+    (0xFF93, "SECOND", 1), (0xFF96, "TKSA", 1), (0xFF99, "MEMTOP", 1),
+    (0xFF9C, "MEMBOT", 1), (0xFF9F, "SCNKEY", 1), (0xFFA2, "SETTMO", 1),
+    (0xFFA5, "ACPTR", 1), (0xFFA8, "CIOUT", 1), (0xFFAB, "UNTLK", 1),
+    (0xFFAE, "UNLSN", 1), (0xFFB1, "LISTEN", 1), (0xFFB4, "TALK", 1),
+    (0xFFB7, "READST", 1), (0xFFBA, "SETLFS", 1), (0xFFBD, "SETNAM", 1),
+    (0xFFC0, "OPEN", 1), (0xFFC3, "CLOSE", 1), (0xFFC6, "CHKIN", 1),
+    (0xFFC9, "CHKOUT", 1), (0xFFCC, "CLRCHN", 1), (0xFFCF, "CHRIN", 1),
+    (0xFFD2, "CHROUT", 1), (0xFFD5, "LOAD", 1), (0xFFD8, "SAVE", 1),
+    (0xFFDB, "SETTIM", 1), (0xFFDE, "RDTIM", 1), (0xFFE1, "STOP", 1),
+    (0xFFE4, "GETIN", 1), (0xFFE7, "CLALL", 1), (0xFFEA, "UDTIM", 1),
+    (0xFFED, "SCREEN", 1), (0xFFF0, "PLOT", 1), (0xFFF3, "IOBASE", 1),
+    (0xFFFA, "NMIVEC", 2), (0xFFFC, "RESVEC", 2), (0xFFFE, "IRQVEC", 2),
+)
+
+VIC = tuple(
+    [(0xD000 + 2 * i, f"SP{i}X", 1) for i in range(8)]
+    + [(0xD001 + 2 * i, f"SP{i}Y", 1) for i in range(8)]
+    + [
+        (0xD010, "MSIGX", 1), (0xD011, "SCROLY", 1), (0xD012, "RASTER", 1),
+        (0xD013, "LPENX", 1), (0xD014, "LPENY", 1), (0xD015, "SPENA", 1),
+        (0xD016, "SCROLX", 1), (0xD017, "YXPAND", 1), (0xD018, "VMCSB", 1),
+        (0xD019, "VICIRQ", 1), (0xD01A, "IRQMSK", 1), (0xD01B, "SPBGPR", 1),
+        (0xD01C, "SPMC", 1), (0xD01D, "XXPAND", 1), (0xD01E, "SPSPCL", 1),
+        (0xD01F, "SPBGCL", 1), (0xD020, "EXTCOL", 1), (0xD021, "BGCOL0", 1),
+        (0xD022, "BGCOL1", 1), (0xD023, "BGCOL2", 1), (0xD024, "BGCOL3", 1),
+        (0xD025, "SPMC0", 1), (0xD026, "SPMC1", 1),
+    ]
+    + [(0xD027 + i, f"SP{i}COL", 1) for i in range(8)]
+    + [(0xD800, "COLRAM", 1024)]
+)
+
+SID = tuple(
+    [
+        (0xD400 + 7 * i + j, f"{name}{i + 1}", 1)
+        for i in range(3)
+        for j, name in enumerate(
+            ("FRELO", "FREHI", "PWLO", "PWHI", "VCREG", "ATDCY", "SUREL")
+        )
+    ]
+    + [
+        (0xD415, "CUTLO", 1), (0xD416, "CUTHI", 1), (0xD417, "RESON", 1),
+        (0xD418, "SIGVOL", 1), (0xD419, "POTX", 1), (0xD41A, "POTY", 1),
+        (0xD41B, "RANDOM", 1), (0xD41C, "ENV3", 1),
+    ]
+)
+
+CIA = (
+    (0xDC00, "CIAPRA", 1), (0xDC01, "CIAPRB", 1), (0xDC02, "CIDDRA", 1),
+    (0xDC03, "CIDDRB", 1), (0xDC04, "TIMALO", 1), (0xDC05, "TIMAHI", 1),
+    (0xDC06, "TIMBLO", 1), (0xDC07, "TIMBHI", 1), (0xDC08, "TODTEN", 1),
+    (0xDC09, "TODSEC", 1), (0xDC0A, "TODMIN", 1), (0xDC0B, "TODHRS", 1),
+    (0xDC0C, "CIASDR", 1), (0xDC0D, "CIAICR", 1), (0xDC0E, "CIACRA", 1),
+    (0xDC0F, "CIACRB", 1),
+    (0xDD00, "CI2PRA", 1), (0xDD01, "CI2PRB", 1), (0xDD02, "C2DDRA", 1),
+    (0xDD03, "C2DDRB", 1), (0xDD04, "TI2ALO", 1), (0xDD05, "TI2AHI", 1),
+    (0xDD06, "TI2BLO", 1), (0xDD07, "TI2BHI", 1), (0xDD08, "TO2TEN", 1),
+    (0xDD09, "TO2SEC", 1), (0xDD0A, "TO2MIN", 1), (0xDD0B, "TO2HRS", 1),
+    (0xDD0C, "CI2SDR", 1), (0xDD0D, "CI2ICR", 1), (0xDD0E, "CI2CRA", 1),
+    (0xDD0F, "CI2CRB", 1),
+)
+# fmt: on
+
+C64 = KERNAL + VIC + SID + CIA
+
+
+class SymbolTable:
+    # symbols for single addresses and for ranges such as tables, kept in
+    # sorted arrays; addresses inside a range resolve to name+offset
+    def __init__(self, symbols=()):
+        self.starts = array("i")
+        self.names = []
+        self.range_starts = array("i")
+        self.range_ends = array("i")
+        self.range_names = []
+        # no range is longer than this, which bounds the search back
+        self.longest = 0
+        self.update(symbols)
+
+    def update(self, symbols):
+        # takes a dict of names by address, or (address, name[, length])
+        if isinstance(symbols, dict):
+            symbols = symbols.items()
+        merged = {addr: (name, length) for addr, name, length in self.items()}
+        for symbol in symbols:
+            addr, name, length = symbol if len(symbol) == 3 else (*symbol, 1)
+            merged[addr] = name, length
+        self.starts = array("i")
+        self.names = []
+        self.range_starts = array("i")
+        self.range_ends = array("i")
+        self.range_names = []
+        for addr in sorted(merged):
+            name, length = merged[addr]
+            if length == 1:
+                self.starts.append(addr)
+                self.names.append(name)
+            else:
+                self.range_starts.append(addr)
+                self.range_ends.append(addr + length)
+                self.range_names.append(name)
+        self.longest = max(
+            (end - start for start, end in zip(self.range_starts, self.range_ends)),
+            default=0,
+        )
+
+    def add(self, addr, name, length=1):
+        self.remove(addr)
+        if length == 1:
+            i = bisect_left(self.starts, addr)
+            self.starts.insert(i, addr)
+            self.names.insert(i, name)
+        else:
+            i = bisect_left(self.range_starts, addr)
+            self.range_starts.insert(i, addr)
+            self.range_ends.insert(i, addr + length)
+            self.range_names.insert(i, name)
+            self.longest = max(self.longest, length)
+
+    def remove(self, addr):
+        # removes the symbol starting at addr, and returns its length
+        i = bisect_left(self.starts, addr)
+        if i < len(self.starts) and self.starts[i] == addr:
+            del self.starts[i]
+            del self.names[i]
+            return 1
+        i = bisect_left(self.range_starts, addr)
+        if i < len(self.range_starts) and self.range_starts[i] == addr:
+            length = self.range_ends[i] - addr
+            del self.range_starts[i]
+            del self.range_ends[i]
+            del self.range_names[i]
+            return length
+        return 0
+
+    def label(self, addr):
+        # name of the symbol starting at addr, or None
+        i = bisect_left(self.starts, addr)
+        if i < len(self.starts) and self.starts[i] == addr:
+            return self.names[i]
+        i = bisect_left(self.range_starts, addr)
+        if i < len(self.range_starts) and self.range_starts[i] == addr:
+            return self.range_names[i]
+        return None
+
+    def get(self, addr, default=None):
+        # name of the symbol at addr, name+offset inside a range, or default
+        starts = self.starts
+        i = bisect_left(starts, addr)
+        if i < len(starts) and starts[i] == addr:
+            return self.names[i]
+        starts = self.range_starts
+        ends = self.range_ends
+        i = bisect_right(starts, addr) - 1
+        # the innermost range that covers addr starts last
+        while i >= 0 and addr - starts[i] < self.longest:
+            if addr < ends[i]:
+                offset = addr - starts[i]
+                name = self.range_names[i]
+                return f"{name}+{offset}" if offset else name
+            i -= 1
+        return default
+
+    def __getitem__(self, addr):
+        name = self.get(addr)
+        if name is None:
+            raise KeyError(addr)
+        return name
+
+    def __contains__(self, addr):
+        return self.get(addr) is not None
+
+    def __len__(self):
+        return len(self.starts) + len(self.range_starts)
+
+    def __iter__(self):
+        return iter(self.items())
+
+    def items(self):
+        # (address, name, length) in address order
+        symbols = [(addr, name, 1) for addr, name in zip(self.starts, self.names)]
+        symbols += [
+            (start, name, end - start)
+            for start, end, name in zip(
+                self.range_starts, self.range_ends, self.range_names
+            )
+        ]
+        return sorted(symbols)
+
+    def load_vice(self, filename):
+        # VICE monitor labels: "al C:d020 .name", one per line
+        symbols = []
+        with open(filename) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3 or fields[0] != "al":
+                    continue
+                addr = fields[1].split(":")[-1]
+                symbols.append((int(addr, 16), fields[2].lstrip(".")))
+        self.update(symbols)
+
+    def save_vice(self, filename):
+        # VICE has no ranges, so these are saved as a label at their start
+        with open(filename, "w") as f:
+            for addr, name, length in self.items():
+                f.write(f"al C:{addr:04x} .{name}\n")
@@ -0,0 +1,121 @@
+# Copyright (c) 2021 J.B. Langston
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import random
+
+import bench
+import booze
+from g64 import open_disk
+from util import to_bytes
+
+
+def sample_prg(seed=1, size=2000, load=0x1000):
+    rng = random.Random(seed)
+    data = bytearray()
+    while len(data) < size:
+        if data and rng.random() < 0.3:
+            distance = rng.randint(1, len(data))
+            for _ in range(rng.randint(2, 50)):
+                data.append(data[-distance])
+        else:
+            data += bytes(rng.randrange(16) for _ in range(rng.randint(1, 40)))
+    return to_bytes(load) + bytes(data[:size])
+
+
+def stub_file(format, basic, prg):
+    # a crunched file with the decruncher code behind the given BASIC line,
+    # and the parameters where that decruncher keeps them
+    info = booze.FORMATS[format]
+    none = booze.FORMATS[format[:2] + "none"]
+    crunched = booze.Boozer(prg, format[:2] + "none").crunch()
+    shift = len(basic) - info.code
+    data = bytearray(basic + info.signature[info.code :])
+    data += bytes(info.next + shift - len(data))
+    dest = info.dest + shift
+    data[dest : dest + 2] = crunched[none.dest : none.dest + 2]
+    if info.first is not None:
+        data[info.first + shift] = crunched[none.first]
+    data[info.next + shift :] = crunched[none.next :]
+    return bytes(data)
+
+
+def test_signature_in_tail_is_raw():
+    info = booze.FORMATS["b2clean"]
+    data = bytes(random.Random(2).randrange(256) for _ in range(500))
+    data += info.signature[info.code :] + bytes(10)
+    assert booze.find_signatures(data) == []
+    assert booze.Deboozer(data).format == "raw"
+
+
+def test_default_basic_line():
+    prg = sample_prg()
+    data = stub_file("b2clean", booze.FORMATS["b2clean"].signature[:14], prg)
+    hits = booze.find_signatures(data)
+    assert [(hit.format, hit.offset) for hit in hits] == [("b2clean", 0)]
+    assert booze.Deboozer(data).decrunch() == prg
+
+
+def test_stub_behind_other_basic_line():
+    prg = sample_prg(3)
+    # 10 SYS 2064
+    basic = bytes.fromhex("0108 0f08 0a00 9e 20 32 30 36 34 00 0000") + bytes(2)
+    for format in ("b1clean", "b1normal", "b2clean"):
+        data = stub_file(format, basic, prg)
+        hits = booze.find_signatures(data)
+        assert [hit.offset for hit in hits] == [len(basic) - 14]
+        decr = booze.Deboozer(data)
+        assert decr.format == format
+        assert decr.decrunch() == prg
+
+
+def test_banking_idiom_in_plain_program_is_raw():
+    # sei / lda #$34 / sta $01 / ldx #$b7 is ordinary setup code too; here
+    # the SYS runs other code, so it must not be taken for a decruncher
+    info = booze.FORMATS["b2clean"]
+    prg = bench.synthetic_part(random.Random(4), 0x0801, 3000)
+    # 10 SYS 2061
+    data = bytearray(info.signature[:14] + prg[16:])
+    data[1500 : 1500 + 7] = info.signature[info.code :]
+    assert booze.find_signatures(bytes(data)) == []
+    assert booze.Deboozer(bytes(data)).format == "raw"
+
+
+def test_false_hit_is_extracted_raw(tmp_path):
+    # a plain program that starts like the b2clean stub is detected, but
+    # fails to decrunch; the disk is still extracted and the file kept raw
+    info = booze.FORMATS["b2clean"]
+    prg = bench.synthetic_part(random.Random(0), 0x0801, 3000)
+    plain = info.signature + prg[2 + len(info.signature) :]
+    part = bench.synthetic_part(random.Random(1), 0x2000, 1000)
+    builder = bench.ImageBuilder()
+    builder.add_file(b"PLAIN", plain)
+    builder.add_index([builder.write_chain(part)[0]])
+    image = tmp_path / "plain.d64"
+    image.write_bytes(builder.build())
+    outdir = tmp_path / "plain.dump"
+    booze.extract_disk(open_disk(str(image)), str(outdir))
+    (name,) = set(os.listdir(outdir / "files")) - {"decrunched"}
+    assert (outdir / "files" / name).read_bytes() == plain
+    assert not os.listdir(outdir / "files" / "decrunched")
+    # no trackformat was taken from the false hit, so parts stay raw too
+    (name,) = os.listdir(outdir / "trackmo")
+    assert (outdir / "trackmo" / name).read_bytes() == part
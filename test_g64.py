@@ -0,0 +1,128 @@
+# Copyright (c) 2021 J.B. Langston
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+import struct
+
+import bench
+from disk import disk_offset, track_sectors
+from g64 import GCR_CODES, G64Disk, checksum, decode_track, open_disk
+
+SYNC = "1" * 40
+GAP = "01010101" * 8
+
+
+def gcr(data):
+    return "".join(f"{GCR_CODES[b >> 4]:05b}{GCR_CODES[b & 0xF]:05b}" for b in data)
+
+
+def encode_track(d64, track, rotate=0, damage=None):
+    # the sectors of a track as a 1541 writes them, with the track rotated
+    # so blocks wrap past its end; damage maps sectors to what is wrong
+    damage = damage or {}
+    bam = disk_offset(18, 0)
+    id1, id2 = d64[bam + 0xA2], d64[bam + 0xA3]
+    bits = ""
+    for sector in range(track_sectors(track)):
+        problem = damage.get(sector)
+        if problem == "sector not found":
+            continue
+        check = sector ^ track ^ id2 ^ id1
+        if problem == "header checksum":
+            check ^= 1
+        header = bytes((0x08, check, sector, track, id2, id1, 0x0F, 0x0F))
+        offset = disk_offset(track, sector)
+        data = d64[offset : offset + 256]
+        check = checksum(data)
+        if problem == "data checksum":
+            check ^= 1
+        block = gcr(bytes((0x07,)) + data + bytes((check, 0, 0)))
+        if problem == "bad GCR code in data block":
+            block = block[:100] + "00000" + block[105:]
+        bits += SYNC + gcr(header) + GAP + SYNC + block + GAP
+    bits += "0" * (-len(bits) % 8)
+    rotate %= len(bits)
+    bits = bits[rotate:] + bits[:rotate]
+    return int(bits, 2).to_bytes(len(bits) // 8, "big")
+
+
+def g64_image(d64, rotate=0, damage=None):
+    # 35 full tracks; the half track entries are left empty
+    damage = damage or {}
+    tracks = [
+        encode_track(d64, track, rotate * track, damage.get(track))
+        for track in range(1, 36)
+    ]
+    size = max(len(data) for data in tracks)
+    image = bytearray(struct.pack("< 8s B B H", b"GCR-1541", 0, 84, size))
+    image += bytes(4 * 84 * 2)
+    for track, data in enumerate(tracks, 1):
+        struct.pack_into("< I", image, 12 + 8 * (track - 1), len(image))
+        image += struct.pack("< H", len(data)) + data + bytes(size - len(data))
+    return bytes(image)
+
+
+def open_g64(tmp_path, image):
+    path = tmp_path / "disk.g64"
+    path.write_bytes(image)
+    return open_disk(str(path))
+
+
+def test_round_trip(tmp_path):
+    d64 = bench.synthetic_d64(parts=4)
+    for rotate in (0, 1237):
+        disk = open_g64(tmp_path, g64_image(d64, rotate))
+        assert isinstance(disk, G64Disk)
+        assert disk.errors == {}
+        assert bytes(disk.image) == d64
+
+
+def test_damaged_sectors(tmp_path):
+    d64 = bench.synthetic_d64(parts=4)
+    damage = {
+        1: {3: "data checksum"},
+        2: {4: "header checksum"},
+        3: {5: "bad GCR code in data block"},
+        4: {6: "sector not found"},
+    }
+    disk = open_g64(tmp_path, g64_image(d64, 311, damage))
+    errors = {
+        (track, sector): problem
+        for track, sectors in damage.items()
+        for sector, problem in sectors.items()
+    }
+    assert disk.errors == errors
+    image = bytearray(d64)
+    # sectors that couldn't be decoded at all are left zeroed; the data of
+    # a sector with a bad checksum is still kept
+    for track, sector in ((3, 5), (4, 6)):
+        offset = disk_offset(track, sector)
+        image[offset : offset + 256] = bytes(256)
+    assert bytes(disk.image) == bytes(image)
+
+
+def test_decode_track():
+    d64 = bench.synthetic_d64(parts=4)
+    sectors = decode_track(encode_track(d64, 18, 999))
+    assert sorted(sectors) == list(range(track_sectors(18)))
+    for sector, (track, data, error) in sectors.items():
+        offset = disk_offset(18, sector)
+        assert (track, data, error) == (18, d64[offset : offset + 256], None)
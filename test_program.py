@@ -0,0 +1,113 @@
+# Copyright (c) 2021 J.B. Langston
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import random
+
+import bench
+import program
+from util import to_bytes
+
+
+def graph(state):
+    nodes = state.flow.nodes.values()
+    return str(state), sorted(
+        (n.addr, n.end, sorted(n.succs), sorted(n.preds)) for n in nodes
+    )
+
+
+def fresh(prg, entries, data):
+    # the same state traced from scratch, with the data marked first
+    state = program.State()
+    state.load_prg(prg)
+    for start, end in data:
+        state.insert_block(program.Data(start, bytes(state.mem[start:end])))
+    for addr in entries:
+        state.trace_asm(addr)
+    return state
+
+
+def test_mark_data_retraces_branch_into_instruction():
+    # the beq skips into the operand of the bit, which is traced as lda #1
+    # once the bit opcode is marked as data
+    prg = to_bytes(0x2000) + bytes.fromhex("a900 f001 2ca901 60")
+    state = program.State()
+    state.load_prg(prg)
+    state.trace_asm(0x2000)
+    assert 0x2005 in state.flow.pending
+    state.mark_data(0x2004, 0x2005)
+    assert 0x2005 in state.flow.nodes
+    assert graph(state) == graph(fresh(prg, [0x2000], [(0x2004, 0x2005)]))
+
+
+def test_mark_data_matches_fresh_trace():
+    for seed in range(5):
+        rng = random.Random(seed)
+        prg = to_bytes(0x1000) + bench.synthetic_code(rng, 0x1000, 2000)
+        state = program.State()
+        state.load_prg(prg)
+        state.trace_asm(0x1000)
+        entries = [0x1000] + rng.sample([b.addr for b in state.blocks], 10)
+        for addr in entries[1:]:
+            state.trace_asm(addr)
+        data = []
+        for _ in range(3):
+            start = rng.randrange(0x1000, 0x1000 + len(prg) - 20)
+            data.append((start, start + rng.randint(1, 16)))
+            state.mark_data(*data[-1])
+        assert graph(state) == graph(fresh(prg, entries, data))
+
+
+def test_mark_data_keeps_blocks_outside_the_range():
+    rng = random.Random(7)
+    prg = to_bytes(0x1000) + bench.synthetic_code(rng, 0x1000, 3000)
+    state = program.State()
+    state.load_prg(prg)
+    state.trace_asm(0x1000)
+    before = dict(state.flow.nodes)
+    state.mark_data(0x1100, 0x1110)
+    kept = [addr for addr, node in state.flow.nodes.items() if before.get(addr) is node]
+    assert len(kept) > len(before) - 20
+    assert graph(state) == graph(fresh(prg, [0x1000], [(0x1100, 0x1110)]))
+
+
+def test_mark_data_over_data_and_basic():
+    prg = to_bytes(0x2000) + bytes(range(16))
+    state = program.State()
+    state.load_prg(prg)
+    state.mark_data(0x2002, 0x2006)
+    state.mark_data(0x2004, 0x2008)
+    assert [(b.addr, b.bytes) for b in state.blocks] == [
+        (0x2002, bytes(range(2, 4))),
+        (0x2004, bytes(range(4, 8))),
+    ]
+    # 10 PRINT "HI" : 20 SYS 2061
+    prg = to_bytes(0x801) + bytes.fromhex(
+        "0b08 0a00 99 22 48 49 22 00 1508 1400 9e 32 30 36 31 00 0000"
+    )
+    state = program.State()
+    state.load_prg(prg)
+    state.mark_data(0x801, 0x805)
+    assert [(b.kind, b.addr) for b in state.blocks] == [
+        (program.DATA, 0x801),
+        (program.BASIC, 0x80B),
+    ]
+    assert set(state.owners[0x805:0x80B]) == {-1}
+    assert not any(state.kinds[0x805:0x80B])
@@ -0,0 +1,70 @@
+# Copyright (c) 2021 J.B. Langston
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+import random
+
+import bench
+import program
+from project import Project
+from test_program import graph
+from util import to_bytes
+
+
+def traced_state():
+    # 10 SYS 2061, then a beq into the operand of a bit, which stays
+    # pending, and enough code to make several blocks
+    code = bytes.fromhex("a900 f001 2ca901 20 1808 60")
+    code += bench.synthetic_code(random.Random(1), 0x818, 300)
+    prg = to_bytes(0x801) + bytes.fromhex("0b08 0a00 9e 32 30 36 31 00 0000") + code
+    state = program.State()
+    state.load_prg(prg)
+    state.trace_asm(0x80D)
+    state.mark_data(0x900, 0x910)
+    return state
+
+
+def flow(state):
+    return (
+        graph(state),
+        sorted(state.flow.entries),
+        {target: sorted(edges) for target, edges in state.flow.pending.items()},
+        bytes(state.mem),
+    )
+
+
+def test_save_load_round_trip(tmp_path):
+    state = traced_state()
+    symbols = [(0x80D, "start", 1), (0x900, "table", 16)]
+    comments = {0x80D: "entry from BASIC"}
+    with Project(str(tmp_path / "demo.db")) as project:
+        project.save("part", state, symbols, comments)
+    with Project(str(tmp_path / "demo.db")) as project:
+        loaded = project.load("part")
+        assert flow(loaded) == flow(state)
+        listing = program.Listing(state, symbols, comments)
+        assert program.Listing(
+            loaded, project.symbols("part"), project.comments("part")
+        ).window(0, 0x10000) == listing.window(0, 0x10000)
+        # the loaded state carries on like the one it was saved from
+        loaded.mark_data(0x820, 0x830)
+        state.mark_data(0x820, 0x830)
+        assert flow(loaded) == flow(state)